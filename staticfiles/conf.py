@@ -28,6 +28,36 @@ class StaticFilesConf(AppConf):
         'staticfiles.finders.AppDirectoriesFinder',
     #    'staticfiles.finders.DefaultStorageFinder',
     )
+    # The file of the index written by the indexstatic command to be used
+    # by the finders instead of looking in the source directories
+    INDEX = None
+    # The version the cache keys of the CachedStaticFilesStorage are
+    # namespaced with, defaults to the digest of its manifest
+    CACHE_VERSION = None
+    # The number of seconds other processes wait for the one hashing a file
+    # for the CachedStaticFilesStorage after a cache miss, None to not wait
+    CACHE_LOCK_TIMEOUT = None
+    # The Cache-Control header of responses for files with hashed names, as
+    # saved by the CachedStaticFilesStorage, which never change
+    HASHED_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    # The Cache-Control header of responses for all other files, e.g.
+    # 'public, max-age=3600', or None to send none
+    CACHE_CONTROL = None
+    # The maximum total size in bytes of the files the StaticFilesHandler
+    # keeps in memory, or 0 to not keep any
+    HANDLER_CACHE_SIZE = 10 * 2 ** 20
+    # The maximum size in bytes of a single file (including its precompressed
+    # variants) kept in memory
+    HANDLER_CACHE_MAX_FILE_SIZE = 64 * 2 ** 10
+    # The number of seconds after which files kept in memory are checked for
+    # changes on disk again, or None to never check them
+    HANDLER_CACHE_VALIDATE = 1
+    # The maximum number of paths the serve view and the handlers remember
+    # as not found by the finders
+    MISSES_MAX_ENTRIES = 10000
+    # The number of seconds after which the directories a path not found
+    # would be in are checked for changes again, or None to never check them
+    MISSES_VALIDATE = 1
 
     def configure_root(self, value):
         """
@@ -1,8 +1,13 @@
+from __future__ import with_statement
 import os
+import stat
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import Storage
+from django.utils import simplejson as json
 from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_str, smart_unicode
 from django.utils.functional import memoize, LazyObject
+from django.utils.hashcompat import md5_constructor
 from django.utils.importlib import import_module
 from django.utils._os import safe_join
 
@@ -10,6 +15,7 @@ from staticfiles import utils, storage
 from staticfiles.conf import settings
 
 _finders = SortedDict()
+_indexes = {}
 
 
 class BaseFinder(object):
@@ -115,20 +121,61 @@ class AppDirectoriesFinder(BaseFinder):
     def __init__(self, apps=None, *args, **kwargs):
         # The list of apps that are handled
         self.apps = []
-        # Mapping of app module paths to storage instances
-        self.storages = SortedDict()
+        # Mapping of app module paths to storage instances (or ``None``
+        # for apps without a static directory), filled on first use
+        self._storages = {}
+        # The mapping of the ``storages`` attribute, built on first access
+        # or assigned
+        self._all_storages = None
         if apps is None:
             apps = settings.INSTALLED_APPS
         for app in apps:
             if app in settings.STATICFILES_EXCLUDED_APPS:
                 continue
-            app_storage = self.storage_class(app)
-            if os.path.isdir(app_storage.location):
-                self.storages[app] = app_storage
-                if app not in self.apps:
-                    self.apps.append(app)
+            if app not in self.apps:
+                self.apps.append(app)
         super(AppDirectoriesFinder, self).__init__(*args, **kwargs)
 
+    def _get_storages(self):
+        if self._all_storages is None:
+            storages = SortedDict()
+            for app in self.apps:
+                app_storage = self.get_storage(app)
+                if app_storage is not None:
+                    storages[app] = app_storage
+            self._all_storages = storages
+        return self._all_storages
+
+    def _set_storages(self, storages):
+        self._all_storages = storages
+
+    storages = property(_get_storages, _set_storages, doc="""
+        Mapping of app module paths to the storage instances of all apps
+        that have a static directory, created on first access.
+
+        The mapping can be changed or replaced, as with the attribute of
+        previous versions, and is used for all lookups from then on.
+        """)
+
+    def get_storage(self, app):
+        """
+        Returns the storage instance of the given app or ``None`` if the
+        app doesn't have a static directory.
+
+        The storage is only created when the app is first looked at, which
+        doesn't require importing the app module.
+        """
+        if self._all_storages is not None:
+            return self._all_storages.get(app)
+        try:
+            return self._storages[app]
+        except KeyError:
+            app_storage = self.storage_class(app)
+            if not os.path.isdir(app_storage.location):
+                app_storage = None
+            self._storages[app] = app_storage
+            return app_storage
+
     def list(self, ignore_patterns):
         """
         List all files in all app storages.
@@ -155,7 +202,7 @@ class AppDirectoriesFinder(BaseFinder):
         """
         Find a requested static file in an app's static locations.
         """
-        storage = self.storages.get(app, None)
+        storage = self.get_storage(app)
         if storage:
             if storage.prefix:
                 prefix = '%s%s' % (storage.prefix, os.sep)
@@ -227,6 +274,169 @@ class DefaultStorageFinder(BaseStorageFinder):
     storage = storage.default_storage
 
 
+class FinderIndex(object):
+    """
+    The complete resolution of all enabled finders, mapping each prefixed
+    path to the absolute paths of all its sources in finder order (the
+    first one wins, the others are shadowed by it).
+
+    It also records the modification times of all directories of the
+    finders (including empty and missing ones), to be able to tell if it's
+    still fresh, and the prefixed paths of the directories, which are left
+    to the finders to look up.
+    """
+    version = 2
+
+    def __init__(self, paths=None, directories=None, fingerprint=None,
+                 directory_paths=None):
+        # Maps prefixed paths to lists of absolute paths
+        self.paths = paths or {}
+        # Maps scanned directories to their modification times (or
+        # ``None`` if they don't exist)
+        self.directories = directories or {}
+        # The prefixed paths of the directories
+        self.directory_paths = set(directory_paths or ())
+        if fingerprint is None:
+            fingerprint = self.get_fingerprint()
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def get_fingerprint(cls):
+        """
+        Returns a hash of the settings the finders depend on.
+        """
+        finder_settings = (settings.STATICFILES_FINDERS,
+                           settings.STATICFILES_DIRS,
+                           settings.STATICFILES_EXCLUDED_APPS,
+                           settings.INSTALLED_APPS,
+                           settings.MEDIA_ROOT)
+        return md5_constructor(smart_str(repr(finder_settings))).hexdigest()
+
+    @classmethod
+    def build(cls, ignore_patterns=None):
+        """
+        Builds the index by listing the files of all enabled finders.
+
+        Files of storages that aren't on the local file system are left
+        out since the finders can't return paths for them either.
+        """
+        if ignore_patterns is None:
+            ignore_patterns = []
+        index = cls()
+        for finder in get_finders():
+            for path, finder_storage in finder.list(ignore_patterns):
+                try:
+                    source_path = finder_storage.path(path)
+                except NotImplementedError:
+                    continue
+                if getattr(finder_storage, 'prefix', None):
+                    prefixed_path = os.path.join(finder_storage.prefix, path)
+                else:
+                    prefixed_path = path
+                sources = index.paths.setdefault(smart_unicode(prefixed_path), [])
+                sources.append(smart_unicode(source_path))
+        for location, finder_storage in get_local_storages():
+            if not os.path.isdir(location):
+                index.directories[location] = None
+                continue
+            prefix = getattr(finder_storage, 'prefix', None) or ''
+            for dirpath, dirnames, filenames in os.walk(location):
+                index.directories[dirpath] = os.stat(dirpath)[stat.ST_MTIME]
+                relative_path = dirpath[len(location):].lstrip(os.sep)
+                directory_path = os.path.join(prefix, relative_path)
+                index.directory_paths.add(
+                    smart_unicode(os.path.normpath(directory_path)))
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads the index from the given file.
+        """
+        with open(filename, 'rb') as index_file:
+            data = json.load(index_file)
+        if data.get('version') != cls.version:
+            raise ValueError("The finder index '%s' has an unsupported "
+                             "version." % filename)
+        return cls(data['paths'], data['directories'], data['fingerprint'],
+                   data['directory_paths'])
+
+    def save(self, filename):
+        """
+        Writes the index to the given file, replacing it atomically.
+        """
+        data = {
+            'version': self.version,
+            'fingerprint': self.fingerprint,
+            'directories': self.directories,
+            'directory_paths': sorted(self.directory_paths),
+            'paths': self.paths,
+        }
+        temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        with open(temp_filename, 'wb') as index_file:
+            json.dump(data, index_file, separators=(',', ':'))
+        os.rename(temp_filename, filename)
+
+    def is_fresh(self):
+        """
+        Checks if the finder settings are unchanged and none of the
+        scanned directories has been modified since the index was built.
+        """
+        if self.fingerprint != self.get_fingerprint():
+            return False
+        for directory, mtime in self.directories.iteritems():
+            try:
+                if os.stat(directory)[stat.ST_MTIME] != mtime:
+                    return False
+            except OSError:
+                if mtime is not None:
+                    return False
+        return True
+
+    def is_directory(self, path):
+        """
+        Returns whether the given path is a directory of the finders.
+        """
+        return smart_unicode(os.path.normpath(path)) in self.directory_paths
+
+    def find(self, path, all=False):
+        """
+        Looks up the given path in the index, with the same return values
+        as the ``find`` function.
+        """
+        matches = self.paths.get(smart_unicode(os.path.normpath(path)))
+        if not matches:
+            # No match.
+            return None
+        if all:
+            return list(matches)
+        return matches[0]
+
+
+def _get_index(filename):
+    """
+    Loads the finder index from the given file if it exists and is fresh.
+    """
+    if not filename:
+        return None
+    try:
+        index = FinderIndex.load(filename)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if not index.is_fresh():
+        return None
+    return index
+_get_index = memoize(_get_index, _indexes, 1)
+
+
+def get_index():
+    """
+    Returns the finder index from the file given in the
+    ``STATICFILES_INDEX`` setting or ``None`` if it's unset or stale.
+    """
+    return _get_index(settings.STATICFILES_INDEX)
+
+
 def find(path, all=False):
     """
     Find a static file with the given path using all enabled finders.
@@ -234,6 +444,9 @@ def find(path, all=False):
     If ``all`` is ``False`` (default), return the first matching
     absolute path (or ``None`` if no match). Otherwise return a list.
     """
+    index = get_index()
+    if index is not None and not index.is_directory(path):
+        return index.find(path, all=all)
     matches = []
     for finder in get_finders():
         result = finder.find(path, all=all)
@@ -256,6 +469,57 @@ def get_finders():
         yield get_finder(finder_path)
 
 
+def get_local_storages():
+    """
+    Returns the file system locations and storages of all enabled finders
+    as pairs, leaving out storages that aren't on the local file system.
+    """
+    local_storages, locations = [], []
+    for finder in get_finders():
+        finder_storages = list(getattr(finder, 'storages', {}).values())
+        if getattr(finder, 'storage', None) is not None:
+            finder_storages.append(finder.storage)
+        for finder_storage in finder_storages:
+            try:
+                location = finder_storage.path('')
+            except NotImplementedError:
+                continue
+            if location not in locations:
+                locations.append(location)
+                local_storages.append((location, finder_storage))
+    return local_storages
+
+
+def get_parent_mtimes(path):
+    """
+    Returns a list of the closest existing directories that would contain
+    a file with the given path in the locations of the enabled finders,
+    with their modification times, which change when the file is added.
+    """
+    mtimes = []
+    for location, finder_storage in get_local_storages():
+        prefix = getattr(finder_storage, 'prefix', None)
+        if prefix:
+            prefix = '%s%s' % (prefix, os.sep)
+            if not path.startswith(prefix):
+                continue
+            path_in_location = path[len(prefix):]
+        else:
+            path_in_location = path
+        directory = os.path.dirname(os.path.join(location, path_in_location))
+        while True:
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                if len(directory) > len(location):
+                    directory = os.path.dirname(directory)
+                    continue
+                mtime = None
+            mtimes.append((directory, mtime))
+            break
+    return mtimes
+
+
 def _get_finder(import_path):
     """
     Imports the staticfiles finder class described by import_path, where
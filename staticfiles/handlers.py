@@ -1,16 +1,40 @@
+import copy
+import os
+import posixpath
+import time
 import urllib
 from urlparse import urlparse
 
-from django.core.handlers.wsgi import WSGIHandler
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.wsgi import WSGIHandler, STATUS_CODE_TEXT
+from django.utils._os import safe_join
+from django.utils.encoding import force_unicode, smart_unicode
 
 from staticfiles.conf import settings
-from staticfiles.views import serve
+from staticfiles.storage import get_name_hash, staticfiles_storage
+from staticfiles.utils import LRUCache
+from staticfiles.views import (serve, serve_file, find_file,
+                               get_static_file, is_immutable_name,
+                               StaticFile, PRECOMPRESSED_VARIANTS)
+
+
+class StaticRequest(object):
+    """
+    The parts of a request needed to serve a static file, taken from the
+    WSGI environ without building a full ``WSGIRequest``.
+    """
+    def __init__(self, environ):
+        self.META = environ
+        self.method = environ['REQUEST_METHOD'].upper()
 
 
 class StaticFilesHandler(WSGIHandler):
     """
     WSGI middleware that intercepts calls to the static files directory, as
     defined by the STATIC_URL setting, and serves those files.
+
+    Small files are kept in memory (see the STATICFILES_HANDLER_CACHE_*
+    settings) and only checked for changes on disk every now and then.
     """
     def __init__(self, application, base_dir=None):
         self.application = application
@@ -19,6 +43,7 @@ class StaticFilesHandler(WSGIHandler):
         else:
             self.base_dir = self.get_base_dir()
         self.base_url = urlparse(self.get_base_url())
+        self.file_cache = LRUCache(settings.STATICFILES_HANDLER_CACHE_SIZE)
         super(StaticFilesHandler, self).__init__()
 
     def get_base_dir(self):
@@ -43,11 +68,91 @@ class StaticFilesHandler(WSGIHandler):
         relative_url = url[len(self.base_url[2]):]
         return urllib.url2pathname(relative_url)
 
+    def find_file(self, path):
+        """
+        Returns the ``StaticFile`` instance for the given path, loaded into
+        memory with its precompressed variants if they are small enough,
+        or ``None`` if there is no such file.
+        """
+        name = posixpath.normpath(urllib.unquote(path)).lstrip('/')
+        if not self.file_cache.max_size:
+            return self.lookup_file(name)
+        now = time.time()
+        entry = self.file_cache.get(name)
+        if entry is not None:
+            static_file, checked = entry
+            validate = settings.STATICFILES_HANDLER_CACHE_VALIDATE
+            if validate is None or now - checked < validate:
+                return static_file
+            if self.is_unchanged(static_file):
+                entry[1] = now
+                return static_file
+            self.file_cache.delete(name)
+        static_file = self.lookup_file(name)
+        if static_file is None:
+            return None
+        # copy the variants, which are shared with other requests otherwise
+        static_file.variants = [(encoding, copy.copy(variant)) for
+                                encoding, variant in static_file.variants]
+        files = [static_file] + [variant for encoding, variant
+                                 in static_file.variants]
+        size = sum([f.size for f in files])
+        if (size <= settings.STATICFILES_HANDLER_CACHE_MAX_FILE_SIZE and
+                static_file.load()):
+            for encoding, variant in static_file.variants:
+                if not variant.load():
+                    return static_file
+            self.file_cache.set(name, [static_file, now], size)
+        return static_file
+
+    def lookup_file(self, name):
+        """
+        Returns the ``StaticFile`` instance for the file the finders find
+        for the given normalized path, or ``None``.
+        """
+        absolute_path = find_file(name)
+        if not absolute_path or os.path.isdir(absolute_path):
+            return None
+        return get_static_file(absolute_path)
+
+    def is_unchanged(self, static_file):
+        """
+        Checks if the given ``StaticFile`` instance and its variants have
+        the same modification time and size as the files on disk.
+        """
+        for static_file in [static_file] + [variant for encoding, variant
+                                            in static_file.variants]:
+            try:
+                statobj = os.stat(static_file.path)
+            except OSError:
+                return False
+            if (statobj.st_mtime, statobj.st_size) != (static_file.mtime,
+                                                       static_file.size):
+                return False
+        return True
+
     def serve(self, request):
         """
-        Actually serves the request path.
+        Actually serves the request path, from memory if possible.
+        """
+        path = self.file_path(request.path)
+        static_file = self.find_file(path)
+        if static_file is not None:
+            return serve_file(request, static_file)
+        return serve(request, path, insecure=True)
+
+    def start_static_response(self, response, start_response):
+        """
+        Starts the WSGI response with the status and headers of the given
+        response, the same way the ``WSGIHandler`` does.
         """
-        return serve(request, self.file_path(request.path), insecure=True)
+        try:
+            status_text = STATUS_CODE_TEXT[response.status_code]
+        except KeyError:
+            status_text = 'UNKNOWN STATUS CODE'
+        status = '%s %s' % (response.status_code, status_text)
+        start_response(status, [(str(k), str(v))
+                                 for k, v in response.items()])
 
     def get_response(self, request):
         from django.http import Http404
@@ -64,5 +169,166 @@ class StaticFilesHandler(WSGIHandler):
     def __call__(self, environ, start_response):
         if not self._should_handle(environ['PATH_INFO']):
             return self.application(environ, start_response)
-        return super(StaticFilesHandler, self).__call__(environ,
-                                                        start_response)
+        # Serve found files right away, leaving only the 404 pages and
+        # directory indexes to the request handling of Django
+        path = self.file_path(force_unicode(environ['PATH_INFO']))
+        static_file = self.find_file(path)
+        if static_file is not None:
+            response = serve_file(StaticRequest(environ), static_file)
+            self.start_static_response(response, start_response)
+        else:
+            response = super(StaticFilesHandler, self).__call__(
+                environ, start_response)
+        # Pass the file wrapper on to let the server stream the file, unless
+        # a middleware has replaced the response content in the meantime
+        file_to_stream = getattr(response, 'file_to_stream', None)
+        if (file_to_stream is not None and
+                getattr(response, '_container', None) is file_to_stream):
+            return file_to_stream
+        return response
+
+
+class StaticRootHandler(StaticFilesHandler):
+    """
+    WSGI middleware that serves the files collected in the STATIC_ROOT
+    directory, even if DEBUG is False, e.g. for small deployments without
+    a separate web server in front of the WSGI application.
+
+    All files are indexed with their response headers when the handler is
+    created. Like the files kept in memory by the ``StaticFilesHandler``,
+    they are checked for changes on disk every now and then (see the
+    STATICFILES_HANDLER_CACHE_VALIDATE setting), and files missing from
+    the index are looked up on disk.
+
+    Only the files listed with their hashed names in the manifest of the
+    STATICFILES_STORAGE (e.g. the ``CachedStaticFilesStorage``) are served
+    as immutable, with the hash in their names as their ETag.
+    """
+    def __init__(self, application, base_dir=None):
+        super(StaticRootHandler, self).__init__(application, base_dir)
+        self.hashed_names, self.manifest_state = frozenset(), None
+        self.files = self.get_files()
+        self.checked = dict.fromkeys(self.files, time.time())
+
+    def get_files(self):
+        """
+        Returns a mapping of the paths of all files in the base directory,
+        relative to the base URL, to ``StaticFile`` instances, including
+        their precompressed variants.
+        """
+        if not self.base_dir:
+            raise ImproperlyConfigured("You're using the staticfiles app "
+                                       "without having set the STATIC_ROOT "
+                                       "setting to a filesystem path.")
+        base_dir = os.path.abspath(self.base_dir)
+        self.load_hashed_names()
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(base_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = path[len(base_dir):].lstrip(os.sep)
+                name = smart_unicode(name.replace(os.sep, '/'))
+                files[name] = self.get_static_file(path, name)
+        for name, static_file in files.iteritems():
+            for encoding, suffix in PRECOMPRESSED_VARIANTS:
+                if name + suffix in files:
+                    static_file.variants.append((encoding,
+                                                 files[name + suffix]))
+        return files
+
+    def load_hashed_names(self):
+        """
+        Loads the hashed names listed in the manifest of the
+        STATICFILES_STORAGE again if it changed on disk. There are none if
+        it has no manifest.
+        """
+        manifest_name = getattr(staticfiles_storage, 'manifest_name', None)
+        statobj = None
+        if manifest_name is not None:
+            try:
+                statobj = os.stat(staticfiles_storage.path(manifest_name))
+            except (NotImplementedError, EnvironmentError):
+                # e.g. not collected yet or a remote storage
+                pass
+        if statobj is None:
+            self.hashed_names, self.manifest_state = frozenset(), None
+            return
+        state = (statobj.st_mtime, statobj.st_size)
+        if state != self.manifest_state:
+            try:
+                manifest = staticfiles_storage.load_manifest()
+            except ValueError:
+                manifest = {}
+            self.hashed_names = frozenset(manifest.values())
+            self.manifest_state = state
+
+    def get_static_file(self, path, name):
+        """
+        Returns the ``StaticFile`` instance for the given absolute path
+        and path relative to the base URL, without its variants.
+        """
+        content_hash = None
+        immutable = is_immutable_name(name, self.hashed_names)
+        if immutable:
+            content_hash = get_name_hash(name)
+        return StaticFile(path, content_hash=content_hash,
+                          immutable=immutable)
+
+    def lookup_file(self, name):
+        """
+        Returns the ``StaticFile`` instance for the file with the given
+        normalized path in the base directory, including its precompressed
+        variants, or ``None``.
+        """
+        try:
+            path = safe_join(os.path.abspath(self.base_dir), name)
+        except ValueError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        self.load_hashed_names()
+        static_file = self.get_static_file(path, name)
+        for encoding, suffix in PRECOMPRESSED_VARIANTS:
+            if os.path.isfile(path + suffix):
+                static_file.variants.append(
+                    (encoding, self.get_static_file(path + suffix,
+                                                    name + suffix)))
+        return static_file
+
+    def find_file(self, path):
+        """
+        Returns the ``StaticFile`` instance for the given path from the
+        index of files, updated if the file changed on disk, or ``None``.
+        """
+        name = posixpath.normpath(path.replace(os.sep, '/')).lstrip('/')
+        static_file = self.files.get(name)
+        validate = settings.STATICFILES_HANDLER_CACHE_VALIDATE
+        if validate is None:
+            return static_file
+        now = time.time()
+        if static_file is not None:
+            if now - self.checked.get(name, 0) < validate:
+                return static_file
+            if self.is_unchanged(static_file):
+                self.checked[name] = now
+                return static_file
+        static_file = self.lookup_file(name)
+        if static_file is None:
+            self.files.pop(name, None)
+            self.checked.pop(name, None)
+        else:
+            self.files[name] = static_file
+            self.checked[name] = now
+        return static_file
+
+    def serve(self, request):
+        """
+        Serves the request path from the index of files.
+        """
+        from django.http import Http404
+
+        path = self.file_path(request.path)
+        static_file = self.find_file(path)
+        if static_file is None:
+            raise Http404("'%s' could not be found" % path)
+        return serve_file(request, static_file)
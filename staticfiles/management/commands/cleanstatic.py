@@ -0,0 +1,61 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.encoding import smart_str
+
+from staticfiles.storage import staticfiles_storage
+from staticfiles.utils import parallel_map
+
+
+class Command(NoArgsCommand):
+    """
+    Command that deletes the hashed files of the ``CachedStaticFilesStorage``
+    which the last manifests written by ``collectstatic`` don't refer to.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('-k', '--keep', type='int', dest='keep', default=3,
+            help="The number of the last manifests whose files to keep. "
+                 "Default: 3."),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=100, help="The number of files to delete at once. "
+                              "Default: 100."),
+        make_option('-n', '--dry-run', action='store_true', dest='dry_run',
+            default=False, help="Only list the files that would be "
+                                "deleted."),
+    )
+    help = ("Deletes the hashed files of the CachedStaticFilesStorage "
+            "that the last manifests don't refer to.")
+    requires_model_validation = False
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        keep = options.get('keep')
+        batch_size = options.get('batch_size') or 100
+        dry_run = options.get('dry_run')
+        storage = staticfiles_storage
+        if not hasattr(storage, 'stale_files'):
+            raise CommandError("The STATICFILES_STORAGE setting doesn't "
+                               "point to a storage using the "
+                               "CachedFilesMixin.")
+        if keep is None or keep < 1:
+            raise CommandError("The number of manifests to keep must be "
+                               "at least 1.")
+        stale = storage.stale_files(keep)
+        for start in range(0, len(stale), batch_size):
+            batch = stale[start:start + batch_size]
+            if verbosity >= 2:
+                for name in batch:
+                    self.stdout.write(smart_str(
+                        u"%s '%s'\n" % (dry_run and 'Pretending to delete'
+                                        or 'Deleting', name)))
+            if not dry_run:
+                parallel_map(storage.delete, batch)
+        if not dry_run:
+            history = storage.load_manifest_history()
+            if len(history) > keep:
+                storage.save_manifest_history(history[-keep:])
+        if verbosity >= 1:
+            self.stdout.write(smart_str(
+                u"%s %s stale file%s.\n" %
+                (dry_run and 'Would delete' or 'Deleted', len(stale),
+                 len(stale) != 1 and 's' or '')))
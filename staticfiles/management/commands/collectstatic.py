@@ -4,12 +4,13 @@ import os
 import sys
 from optparse import make_option
 
-from django.core.files.storage import FileSystemStorage
+from django.core.files.storage import FileSystemStorage, get_storage_class
 from django.core.management.base import CommandError, NoArgsCommand
 from django.utils.encoding import smart_str, smart_unicode
 from django.utils.datastructures import SortedDict
+from django.utils.hashcompat import md5_constructor
 
-from staticfiles import finders, storage
+from staticfiles import finders, storage, utils
 from staticfiles.conf import settings
 
 
@@ -43,6 +44,15 @@ class Command(NoArgsCommand):
             dest='use_default_ignore_patterns', default=True,
             help="Don't ignore the common private glob-style patterns 'CVS', "
                 "'.*' and '*~'."),
+        make_option('-s', '--storage', action='append', default=[],
+            dest='storages', metavar='STORAGE',
+            help="Also collect the files to this storage class (a full "
+                 "Python path) besides STATICFILES_STORAGE. Use multiple "
+                 "times to add more."),
+        make_option('--report-duplicates', action='store_true',
+            dest='report_duplicates', default=False,
+            help="Report shadowed files and files with identical content "
+                 "instead of collecting them."),
     )
     help = "Collect static files in a single location."
     requires_model_validation = False
@@ -54,12 +64,9 @@ class Command(NoArgsCommand):
         self.unmodified_files = []
         self.post_processed_files = []
         self.storage = storage.staticfiles_storage
-        try:
-            self.storage.path('')
-        except NotImplementedError:
-            self.local = False
-        else:
-            self.local = True
+        # All destination storages, starting with the configured one
+        self.storages = [self.storage]
+        self.local = self.is_local(self.storage)
         # Use ints for file times (ticket #14665), if supported
         if hasattr(os, 'stat_float_times'):
             os.stat_float_times(False)
@@ -79,22 +86,47 @@ class Command(NoArgsCommand):
             ignore_patterns += ['CVS', '.*', '*~']
         self.ignore_patterns = list(set(ignore_patterns))
         self.post_process = options['post_process']
+        self.report_duplicates = options.get('report_duplicates', False)
+        self.storages = [self.storage] + [get_storage_class(path)()
+                                          for path in options.get('storages', [])]
+
+    def is_local(self, storage):
+        """
+        Checks if the given destination storage is on the local file system.
+        """
+        try:
+            storage.path('')
+        except NotImplementedError:
+            return False
+        return True
 
-    def collect(self):
+    def collect(self, storages=None):
         """
         Perform the bulk of the work of collectstatic.
 
         Split off from handle_noargs() to facilitate testing.
+
+        The files are collected to all given destination storages (by
+        default the ``STATICFILES_STORAGE`` and the ones passed with the
+        ``--storage`` option). Each source file is opened once and
+        streamed to all destinations needing it, and post-processing
+        hashes and scans it once.
         """
+        if storages is not None:
+            self.storages = list(storages)
+
         if self.symlink:
             if sys.platform == 'win32':
                 raise CommandError("Symlinking is not supported by this "
                                    "platform (%s)." % sys.platform)
-            if not self.local:
-                raise CommandError("Can't symlink to a remote destination.")
+            for destination in self.storages:
+                if not self.is_local(destination):
+                    raise CommandError("Can't symlink to a remote "
+                                       "destination.")
 
         if self.clear:
-            self.clear_dir('')
+            for destination in self.storages:
+                self.clear_dir('', destination)
 
         if self.symlink:
             handler = self.link_file
@@ -112,16 +144,25 @@ class Command(NoArgsCommand):
                 found_files[prefixed_path] = (storage, path)
                 handler(path, prefixed_path, storage)
 
-        # Here we check if the storage backend has a post_process
-        # method and pass it the list of modified files.
-        if self.post_process and hasattr(self.storage, 'post_process'):
-            processor = self.storage.post_process(found_files,
-                                                  dry_run=self.dry_run)
+        # Here we check if the storage backends have a post_process
+        # method and pass it the list of modified files. The hashes of
+        # the files and the references found in them are shared between
+        # the storages, too.
+        hashed_names, references = {}, {}
+        for destination in self.storages:
+            if not (self.post_process and
+                    hasattr(destination, 'post_process')):
+                continue
+            processor = destination.post_process(found_files,
+                                                 dry_run=self.dry_run,
+                                                 hashed_names=hashed_names,
+                                                 references=references)
             for original_path, processed_path, processed in processor:
                 if processed:
                     self.log(u"Post-processed '%s' as '%s" %
                              (original_path, processed_path), level=1)
-                    self.post_processed_files.append(original_path)
+                    if original_path not in self.post_processed_files:
+                        self.post_processed_files.append(original_path)
                 else:
                     self.log(u"Skipped post-processing '%s'" % original_path)
 
@@ -131,8 +172,87 @@ class Command(NoArgsCommand):
             'post_processed': self.post_processed_files,
         }
 
+    def find_duplicates(self):
+        """
+        Scan all source files once and return a three-tuple of a mapping
+        of the prefixed paths found in more than one location to their
+        sources (the first one is collected, the rest is shadowed), a list
+        of groups of source files with identical content and a mapping of
+        the compared source files to their sizes.
+
+        Only files with the same size are read, in parallel, to compare
+        their content.
+        """
+        index = finders.FinderIndex.build(self.ignore_patterns)
+        shadowed = SortedDict()
+        sizes = {}
+        for prefixed_path in sorted(index.paths):
+            sources = index.paths[prefixed_path]
+            if len(sources) > 1:
+                shadowed[prefixed_path] = sources
+            for source in sources:
+                sizes[source] = os.path.getsize(source)
+        by_size = {}
+        for source, size in sizes.iteritems():
+            by_size.setdefault(size, []).append(source)
+        candidates = [candidate for group in by_size.itervalues()
+                      if len(group) > 1 for candidate in group]
+        digests = utils.parallel_map(self.file_digest, candidates)
+        by_digest = {}
+        for source, digest in zip(candidates, digests):
+            by_digest.setdefault(digest, []).append(source)
+        identical = sorted([sorted(group)
+                            for group in by_digest.itervalues()
+                            if len(group) > 1])
+        return shadowed, identical, sizes
+
+    def file_digest(self, path):
+        """
+        Returns the MD5 hex digest of the content of the given file.
+        """
+        md5 = md5_constructor()
+        source_file = open(path, 'rb')
+        try:
+            for chunk in iter(lambda: source_file.read(64 * 2 ** 10), ''):
+                md5.update(chunk)
+        finally:
+            source_file.close()
+        return md5.hexdigest()
+
+    def report(self):
+        """
+        Writes the report of shadowed and identical files.
+        """
+        shadowed, identical, sizes = self.find_duplicates()
+        shadowed_count = shadowed_size = 0
+        if shadowed:
+            self.log(u"Shadowed files:", level=1)
+        for prefixed_path, sources in shadowed.iteritems():
+            self.log(u"  %s" % prefixed_path, level=1)
+            self.log(u"    collected: %s" % sources[0], level=1)
+            for source in sources[1:]:
+                self.log(u"    shadowed:  %s" % source, level=1)
+                shadowed_count += 1
+                shadowed_size += sizes[source]
+        identical_size = 0
+        if identical:
+            self.log(u"Files with identical content:", level=1)
+        for sources in identical:
+            self.log(u"  %s bytes each:" % sizes[sources[0]], level=1)
+            for source in sources:
+                self.log(u"    %s" % source, level=1)
+            identical_size += sizes[sources[0]] * (len(sources) - 1)
+        self.log(u"\n%s shadowed file%s (%s bytes), %s group%s of identical "
+                 u"files (%s redundant bytes)." %
+                 (shadowed_count, shadowed_count != 1 and 's' or '',
+                  shadowed_size, len(identical),
+                  len(identical) != 1 and 's' or '', identical_size),
+                 level=1)
+
     def handle_noargs(self, **options):
         self.set_options(**options)
+        if self.report_duplicates:
+            return self.report()
         # Warn before doing anything more.
         if (isinstance(self.storage, FileSystemStorage) and
                 self.storage.location):
@@ -141,6 +261,10 @@ class Command(NoArgsCommand):
         else:
             destination_path = None
             destination_display = '.'
+        for destination in self.storages[1:]:
+            if (isinstance(destination, FileSystemStorage) and
+                    destination.location):
+                destination_display += '\n    %s' % destination.location
 
         if self.clear:
             clear_display = 'This will DELETE EXISTING FILES!'
@@ -192,11 +316,13 @@ Type 'yes' to continue, or 'no' to cancel: """
         if self.verbosity >= level:
             self.stdout.write(msg)
 
-    def clear_dir(self, path):
+    def clear_dir(self, path, storage=None):
         """
         Deletes the given relative path using the destinatin storage backend.
         """
-        dirs, files = self.storage.listdir(path)
+        if storage is None:
+            storage = self.storage
+        dirs, files = storage.listdir(path)
         for f in files:
             fpath = os.path.join(path, f)
             if self.dry_run:
@@ -204,17 +330,24 @@ Type 'yes' to continue, or 'no' to cancel: """
                          smart_unicode(fpath), level=1)
             else:
                 self.log(u"Deleting '%s'" % smart_unicode(fpath), level=1)
-                self.storage.delete(fpath)
+                storage.delete(fpath)
         for d in dirs:
-            self.clear_dir(os.path.join(path, d))
+            self.clear_dir(os.path.join(path, d), storage)
+
+    def delete_file(self, path, prefixed_path, source_storage, storage=None):
+        """
+        Checks if the target file should be deleted if it already exists
+        in the given destination storage (by default the configured one).
 
-    def delete_file(self, path, prefixed_path, source_storage):
-        # Checks if the target file should be deleted if it already exists
-        if self.storage.exists(prefixed_path):
+        Returns ``False`` if the file doesn't need to be copied or linked
+        to that destination since it's not modified.
+        """
+        if storage is None:
+            storage = self.storage
+        if storage.exists(prefixed_path):
             try:
                 # When was the target file modified last time?
-                target_last_modified = \
-                    self.storage.modified_time(prefixed_path)
+                target_last_modified = storage.modified_time(prefixed_path)
             except (OSError, NotImplementedError, AttributeError):
                 # The storage doesn't support ``modified_time`` or failed
                 pass
@@ -226,8 +359,8 @@ Type 'yes' to continue, or 'no' to cancel: """
                     pass
                 else:
                     # The full path of the target file
-                    if self.local:
-                        full_path = self.storage.path(prefixed_path)
+                    if self.is_local(storage):
+                        full_path = storage.path(prefixed_path)
                     else:
                         full_path = None
                     # Skip the file if the source file is younger
@@ -236,8 +369,6 @@ Type 'yes' to continue, or 'no' to cancel: """
                                  and not os.path.islink(full_path)) or
                                 (not self.symlink and full_path
                                  and os.path.islink(full_path))):
-                            if prefixed_path not in self.unmodified_files:
-                                self.unmodified_files.append(prefixed_path)
                             self.log(u"Skipping '%s' (not modified)" % path)
                             return False
             # Then delete the existing file if really needed
@@ -245,9 +376,22 @@ Type 'yes' to continue, or 'no' to cancel: """
                 self.log(u"Pretending to delete '%s'" % path)
             else:
                 self.log(u"Deleting '%s'" % path)
-                self.storage.delete(prefixed_path)
+                storage.delete(prefixed_path)
         return True
 
+    def get_destinations(self, path, prefixed_path, source_storage):
+        """
+        Returns the destination storages the given file needs to be copied
+        or linked to, deleting outdated copies on the way. The file is
+        marked as unmodified if no destination is left.
+        """
+        destinations = [destination for destination in self.storages
+                        if self.delete_file(path, prefixed_path,
+                                            source_storage, destination)]
+        if not destinations and prefixed_path not in self.unmodified_files:
+            self.unmodified_files.append(prefixed_path)
+        return destinations
+
     def link_file(self, path, prefixed_path, source_storage):
         """
         Attempt to link ``path``
@@ -255,8 +399,10 @@ Type 'yes' to continue, or 'no' to cancel: """
         # Skip this file if it was already copied earlier
         if prefixed_path in self.symlinked_files:
             return self.log(u"Skipping '%s' (already linked earlier)" % path)
-        # Delete the target file if needed or break
-        if not self.delete_file(path, prefixed_path, source_storage):
+        # Delete the target files if needed or break
+        destinations = self.get_destinations(path, prefixed_path,
+                                             source_storage)
+        if not destinations:
             return
         # The full path of the source file
         source_path = source_storage.path(path)
@@ -265,12 +411,13 @@ Type 'yes' to continue, or 'no' to cancel: """
             self.log(u"Pretending to link '%s'" % source_path, level=1)
         else:
             self.log(u"Linking '%s'" % source_path, level=1)
-            full_path = self.storage.path(prefixed_path)
-            try:
-                os.makedirs(os.path.dirname(full_path))
-            except OSError:
-                pass
-            os.symlink(source_path, full_path)
+            for destination in destinations:
+                full_path = destination.path(prefixed_path)
+                try:
+                    os.makedirs(os.path.dirname(full_path))
+                except OSError:
+                    pass
+                os.symlink(source_path, full_path)
         if prefixed_path not in self.symlinked_files:
             self.symlinked_files.append(prefixed_path)
 
@@ -281,8 +428,10 @@ Type 'yes' to continue, or 'no' to cancel: """
         # Skip this file if it was already copied earlier
         if prefixed_path in self.copied_files:
             return self.log(u"Skipping '%s' (already copied earlier)" % path)
-        # Delete the target file if needed or break
-        if not self.delete_file(path, prefixed_path, source_storage):
+        # Delete the target files if needed or break
+        destinations = self.get_destinations(path, prefixed_path,
+                                             source_storage)
+        if not destinations:
             return
         # The full path of the source file
         source_path = source_storage.path(path)
@@ -291,15 +440,19 @@ Type 'yes' to continue, or 'no' to cancel: """
             self.log(u"Pretending to copy '%s'" % source_path, level=1)
         else:
             self.log(u"Copying '%s'" % source_path, level=1)
-            if self.local:
-                full_path = self.storage.path(prefixed_path)
-                try:
-                    os.makedirs(os.path.dirname(full_path))
-                except OSError:
-                    pass
+            # Open the source file once and stream it to each destination,
+            # rewinding it in between instead of holding it in memory
             source_file = source_storage.open(path)
             try:
-                self.storage.save(prefixed_path, source_file)
+                for destination in destinations:
+                    if self.is_local(destination):
+                        full_path = destination.path(prefixed_path)
+                        try:
+                            os.makedirs(os.path.dirname(full_path))
+                        except OSError:
+                            pass
+                    source_file.seek(0)
+                    destination.save(prefixed_path, source_file)
             finally:
                 source_file.close()
         if not prefixed_path in self.copied_files:
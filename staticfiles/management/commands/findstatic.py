@@ -1,7 +1,8 @@
 import os
 import sys
 from optparse import make_option
-from django.core.management.base import LabelCommand
+from django.core.management.base import CommandError, LabelCommand
+from django.utils import simplejson as json
 from django.utils.encoding import smart_str, smart_unicode
 
 from staticfiles import finders
@@ -14,17 +15,59 @@ class Command(LabelCommand):
     option_list = LabelCommand.option_list + (
         make_option('--first', action='store_false', dest='all', default=True,
                     help="Only return the first match for each static file."),
+        make_option('--stdin', action='store_true', dest='stdin',
+                    default=False,
+                    help="Also read the static files to find from standard "
+                         "input, one per line."),
+        make_option('--json', action='store_true', dest='json', default=False,
+                    help="Output the matches of all static files as a JSON "
+                         "object."),
     )
+    index = None
+
+    def handle(self, *labels, **options):
+        if not (options.get('stdin') or options.get('json')):
+            return super(Command, self).handle(*labels, **options)
+        labels = list(labels)
+        if options['stdin']:
+            labels.extend([line.strip() for line in sys.stdin
+                           if line.strip()])
+        if not labels:
+            raise CommandError('Enter at least one %s.' % self.label)
+        # Resolve all paths with a single index instead of running all
+        # finders for every single path
+        self.index = finders.get_index() or finders.FinderIndex.build()
+        if not options['json']:
+            for label in labels:
+                self.handle_label(label, **options)
+            return
+        results = {}
+        for label in labels:
+            result = self.find(label, all=options['all'])
+            if options['all']:
+                result = [self.realpath(path) for path in result or []]
+            elif result:
+                result = self.realpath(result)
+            results[smart_unicode(label)] = result
+        sys.stdout.write(smart_str(json.dumps(results, indent=2)) + '\n')
+
+    def find(self, path, all=False):
+        if self.index is not None and not self.index.is_directory(path):
+            return self.index.find(path, all=all)
+        return finders.find(path, all=all)
+
+    def realpath(self, path):
+        return smart_unicode(os.path.realpath(path))
 
     def handle_label(self, path, **options):
         verbosity = int(options.get('verbosity', 1))
-        result = finders.find(path, all=options['all'])
+        result = self.find(path, all=options['all'])
         path = smart_unicode(path)
         if result:
             if not isinstance(result, (list, tuple)):
                 result = [result]
             output = u'\n  '.join(
-                (smart_unicode(os.path.realpath(path)) for path in result))
+                (self.realpath(path) for path in result))
             sys.stdout.write(
                 smart_str(u"Found '%s' here:\n  %s\n" % (path, output)))
         else:
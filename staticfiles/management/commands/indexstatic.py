@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.encoding import smart_str
+
+from staticfiles import finders
+from staticfiles.conf import settings
+
+
+class Command(NoArgsCommand):
+    """
+    Command that writes the resolution of all enabled finders to an index
+    file which is used by the finders instead of the source directories.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('-o', '--output', dest='output', default=None,
+            metavar='FILE',
+            help="The file to write the index to. Defaults to the "
+                 "STATICFILES_INDEX setting."),
+    )
+    help = "Writes an index of the files found by the static files finders."
+    requires_model_validation = False
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        filename = options['output'] or settings.STATICFILES_INDEX
+        if not filename:
+            raise CommandError("Either set the STATICFILES_INDEX setting "
+                               "or pass the --output option.")
+        index = finders.FinderIndex.build()
+        index.save(filename)
+        if verbosity >= 1:
+            self.stdout.write(smart_str(
+                u"Indexed %s static file path%s in '%s'.\n" %
+                (len(index.paths), len(index.paths) != 1 and 's' or '',
+                 filename)))
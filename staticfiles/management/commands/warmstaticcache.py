@@ -0,0 +1,65 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.encoding import smart_str
+
+from staticfiles.storage import (get_name_hash, get_original_name,
+                                 staticfiles_storage)
+from staticfiles.utils import get_files, parallel_map
+
+
+class Command(NoArgsCommand):
+    """
+    Command that sets the hashed names of all collected files in the cache
+    of the ``CachedStaticFilesStorage``, without copying any files.
+    """
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rehash', action='store_true', dest='rehash',
+            default=False, help="Hash the collected files instead of "
+                                "reading the hashed names from the manifest."),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=500, help="The number of cache entries to set at once. "
+                              "Default: 500."),
+    )
+    help = ("Fills the cache of the CachedStaticFilesStorage with the "
+            "hashed names of the collected files.")
+    requires_model_validation = False
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options.get('chunk_size') or 500
+        storage = staticfiles_storage
+        if not hasattr(storage, 'load_manifest'):
+            raise CommandError("The STATICFILES_STORAGE setting doesn't "
+                               "point to a storage using the "
+                               "CachedFilesMixin.")
+        hashed_names = {}
+        if not options.get('rehash'):
+            hashed_names = storage.load_manifest()
+        if not hashed_names:
+            hashed_names = self.rehash(storage)
+        version = storage.cache_version()
+        items = sorted(hashed_names.items())
+        for start in range(0, len(items), chunk_size):
+            storage.cache.set_many(dict([
+                (storage.cache_key(name, version), hashed_name)
+                for name, hashed_name in items[start:start + chunk_size]]))
+        if verbosity >= 1:
+            self.stdout.write(smart_str(
+                u"Set %s cache entr%s for version '%s'.\n" %
+                (len(items), len(items) != 1 and 'ies' or 'y', version)))
+
+    def rehash(self, storage):
+        """
+        Returns a mapping of the names of all collected files (but not
+        their hashed copies, precompressed variants or the manifests) to
+        their hashed names, hashing the files in parallel.
+        """
+        names = [name.replace('\\', '/') for name in get_files(storage)]
+        names = [name for name in names
+                 if not get_name_hash(name) and
+                 get_original_name(name) == name and
+                 not storage.is_internal(name)]
+        hashed_names = parallel_map(
+            lambda name: storage.hashed_name(name).replace('\\', '/'), names)
+        return dict(zip(names, hashed_names))
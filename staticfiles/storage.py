@@ -1,7 +1,15 @@
 from __future__ import with_statement
+import imp
+import mmap
 import os
 import posixpath
 import re
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
 import warnings
 
 from datetime import datetime
@@ -17,11 +25,13 @@ from django.core.files.storage import FileSystemStorage, get_storage_class
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import force_unicode, smart_str
 from django.utils.datastructures import SortedDict
-from django.utils.functional import LazyObject
+from django.utils import simplejson as json
+from django.utils.functional import LazyObject, memoize
 from django.utils.importlib import import_module
 from django.utils.hashcompat import md5_constructor
 
-from staticfiles.utils import matches_patterns
+from staticfiles.utils import (dependency_order, get_files,
+                               matches_patterns, StreamRewriter)
 
 
 def setattr_ifmissing(clss, name, func):
@@ -41,6 +51,105 @@ def __exit__(self, exc_type, exc_value, tb):
 setattr_ifmissing([File, ContentFile], '__enter__', __enter__)
 setattr_ifmissing([File, ContentFile], '__exit__', __exit__)
 
+_app_paths = {}
+# The locks of the threads hashing the files, shared by the cache keys with
+# the same hash modulo their number
+_hashing_locks = [threading.Lock() for i in range(64)]
+
+# The file names created by ``CachedFilesMixin.hashed_name``
+hashed_name_re = re.compile(r'^.+\.([0-9a-f]{12})(\.[^.]+)?$')
+
+# The precompressed variants of files by content coding and their suffix,
+# in order of preference
+PRECOMPRESSED_VARIANTS = (
+    ('gzip', '.gz'),
+)
+
+
+def get_staticfiles_cache():
+    """
+    Returns the ``staticfiles`` cache backend or the default cache if
+    there isn't one configured.
+    """
+    try:
+        return get_cache('staticfiles')
+    except (InvalidCacheBackendError, ValueError):
+        # Use the default backend
+        return default_cache
+
+
+def get_name_hash(name):
+    """
+    Returns the content hash which is part of the given file name if it
+    looks like one created by ``CachedFilesMixin.hashed_name``, else
+    ``None``.
+    """
+    match = hashed_name_re.match(os.path.basename(name))
+    if match:
+        return match.group(1)
+    return None
+
+
+def get_original_name(name):
+    """
+    Returns the name of the file the given precompressed variant (e.g.
+    ``css/styles.css.gz``) was made of, or the given name otherwise.
+    """
+    for encoding, suffix in PRECOMPRESSED_VARIANTS:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def find_app_path(app):
+    """
+    Finds the directory of the given app module with the help of the
+    ``imp`` module, without importing the app (or its parent packages,
+    unless they have been imported already).
+    """
+    parent, _, name = app.rpartition('.')
+    search_path = None
+    if parent:
+        parent_module = sys.modules.get(parent)
+        if parent_module is not None and hasattr(parent_module, '__path__'):
+            search_path = parent_module.__path__
+        else:
+            search_path = [find_app_path(parent)]
+    fp, pathname, description = imp.find_module(name, search_path)
+    if fp is not None:
+        fp.close()
+    if description[2] == imp.PKG_DIRECTORY:
+        return pathname
+    return os.path.dirname(pathname)
+
+
+def _get_app_path(app):
+    """
+    Returns the directory of the given app module.
+
+    Already imported modules are looked up in ``sys.modules``, other apps
+    are found in the ``staticfiles`` cache (keyed by the current
+    ``sys.path``, so it can be shared between processes of the same
+    deployment) or located on the file system without importing them.
+    """
+    module = sys.modules.get(app)
+    if module is not None and getattr(module, '__file__', None):
+        return os.path.dirname(module.__file__)
+    cache = get_staticfiles_cache()
+    path_hash = md5_constructor(smart_str(os.pathsep.join(sys.path)))
+    cache_key = 'staticfiles:app:%s:%s' % (path_hash.hexdigest(), app)
+    app_path = cache.get(cache_key)
+    if app_path is None or not os.path.isdir(app_path):
+        try:
+            app_path = find_app_path(app)
+        except ImportError:
+            # e.g. apps in zipped eggs or behind custom import hooks
+            mod = import_module(app)
+            app_path = os.path.dirname(mod.__file__)
+        cache.set(cache_key, app_path)
+    return app_path
+get_app_path = memoize(_get_app_path, _app_paths, 1)
+
 
 class TimeAwareFileSystemStorage(FileSystemStorage):
     def accessed_time(self, name):
@@ -93,31 +202,207 @@ class StaticFileStorage(StaticFilesStorage):
         super(StaticFileStorage, self).__init__(*args, **kwargs)
 
 
+class CompactManifest(object):
+    """
+    A read-only mapping of file names to hashed names, stored in a file
+    which is memory-mapped instead of parsed, so that all processes of a
+    server share one copy of it in the page cache.
+
+    The file consists of a header, a table of the offsets and lengths of
+    the UTF-8 encoded names and hashed names, sorted by name, and the
+    encoded strings. Names are looked up with a binary search.
+    """
+    magic = 'SFM1'
+    header = struct.Struct('<4sI')
+    entry = struct.Struct('<IIII')
+
+    def __init__(self, path):
+        fp = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        if len(self.map) < self.header.size:
+            raise ValueError("The manifest '%s' is truncated." % path)
+        magic, self.count = self.header.unpack_from(self.map, 0)
+        if (magic != self.magic or len(self.map) <
+                self.header.size + self.count * self.entry.size):
+            raise ValueError("The manifest '%s' is invalid." % path)
+
+    @classmethod
+    def dumps(cls, hashed_names):
+        """
+        Returns the content of a manifest file for the given mapping.
+        """
+        items = sorted([(smart_str(name), smart_str(hashed_name))
+                        for name, hashed_name in hashed_names.iteritems()])
+        table, strings = [], []
+        offset = cls.header.size + len(items) * cls.entry.size
+        for name, hashed_name in items:
+            table.append(cls.entry.pack(offset, len(name),
+                                        offset + len(name), len(hashed_name)))
+            strings.extend([name, hashed_name])
+            offset += len(name) + len(hashed_name)
+        return ''.join([cls.header.pack(cls.magic, len(items))] +
+                       table + strings)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, name, default=None):
+        key = smart_str(name)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            (name_offset, name_length, value_offset,
+             value_length) = self.entry.unpack_from(
+                self.map, self.header.size + middle * self.entry.size)
+            candidate = self.map[name_offset:name_offset + name_length]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return self.map[value_offset:
+                                value_offset + value_length].decode('utf-8')
+        return default
+
+    def close(self):
+        self.map.close()
+
+
 class CachedFilesMixin(object):
+    manifest_name = 'staticfiles.json'
+    compact_manifest_name = 'staticfiles.manifest'
+    processed_manifest_name = 'staticfiles.processed.json'
+    manifest_history_name = 'staticfiles.history.json'
+    # the size of the chunks files without a file descriptor are hashed in
+    hash_chunk_size = 2 ** 20
+    manifest_version = 1
+    default_template = """url("%s")"""
+    # The references to rewrite in the files matching each glob pattern,
+    # as pairs of a regular expression (the first group matching the whole
+    # reference, the second its URL) and the template of the replacement.
+    # A template of None only replaces the URL in the matched text.
     patterns = (
         ("*.css", (
-            r"""(url\(['"]{0,1}\s*(.*?)["']{0,1}\))""",
-            r"""(@import\s*["']\s*(.*?)["'])""",
+            (r"""(/\*# sourceMappingURL=([^\s*]+)\s*\*/)""",
+             """/*# sourceMappingURL=%s */"""),
+            (r"""(url\(['"]{0,1}\s*([^()\n]*?)["']{0,1}\))""",
+             """url("%s")"""),
+            (r"""(@import\s*["']\s*([^"'\n]*?)["'])""",
+             """@import url("%s")"""),
+        )),
+        ("*.js", (
+            (r"""(//# sourceMappingURL=([^\s'"]+))""",
+             """//# sourceMappingURL=%s"""),
+            (r"""((?:import|export)\s*(?:\(\s*|[\w$*{},\s]*?\s*from\s*)?"""
+             r"""["']([./][^"'\n]*)["'])""", None),
+        )),
+        ("*.svg", (
+            (r"""(href\s*=\s*["']([^"'{\n]*)["'])""", None),
+            (r"""(url\(['"]{0,1}\s*([^()\n]*?)["']{0,1}\))""",
+             """url("%s")"""),
+        )),
+        ("*.html", (
+            (r"""(<link\s[^>]*?href\s*=\s*["']([^"'{\n]*)["'])""", None),
+            (r"""(src\s*=\s*["']([^"'{\n]*)["'])""", None),
+        )),
+    )
+    # The files whose references to files that can't be found are left as
+    # they are (e.g. module paths without the file extension) instead of
+    # raising a ValueError
+    ignore_missing_patterns = ("*.js", "*.svg", "*.html")
+    # The parts of the files to leave alone, even if the patterns above
+    # match something in them
+    skipped_patterns = (
+        ("*.css", (
+            r"""/\*(?:[^*]|\*(?!/))*(?:\*/|\Z)""",
+            r"""'(?:[^'\\\n]|\\.)*'""",
+            r'''"(?:[^"\\\n]|\\.)*"''',
+        )),
+        ("*.js", (
+            r"""/\*(?:[^*]|\*(?!/))*(?:\*/|\Z)""",
+            r"""//[^\n]*""",
+            r"""'(?:[^'\\\n]|\\.)*'""",
+            r'''"(?:[^"\\\n]|\\.)*"''',
+            r"""`(?:[^`\\]|\\.)*(?:`|\Z)""",
+        )),
+        ("*.svg", (
+            r"""<!--(?:[^-]|-(?!->))*(?:-->|\Z)""",
+        )),
+        ("*.html", (
+            r"""<!--(?:[^-]|-(?!->))*(?:-->|\Z)""",
         )),
     )
 
     def __init__(self, *args, **kwargs):
         super(CachedFilesMixin, self).__init__(*args, **kwargs)
-        try:
-            self.cache = get_cache('staticfiles')
-        except (InvalidCacheBackendError, ValueError):
-            # Use the default backend
-            self.cache = default_cache
+        self.cache = get_staticfiles_cache()
+        self._cache_version = None
+        self._compact_manifest = None
         self._patterns = SortedDict()
+        self._templates = {}
         for extension, patterns in self.patterns:
             for pattern in patterns:
+                if isinstance(pattern, basestring):
+                    pattern, template = pattern, self.default_template
+                else:
+                    pattern, template = pattern
                 compiled = re.compile(pattern)
                 self._patterns.setdefault(extension, []).append(compiled)
+                self._templates[compiled] = template
+        skipped_patterns = {}
+        for extension, patterns in self.skipped_patterns:
+            for pattern in patterns:
+                compiled = re.compile(pattern)
+                skipped_patterns.setdefault(extension, []).append(compiled)
+        self._rewriters = SortedDict()
+        for extension, patterns in self._patterns.items():
+            self._rewriters[extension] = StreamRewriter(
+                patterns, skipped_patterns.get(extension, ()))
+
+    def file_hash(self, name, content):
+        """
+        Returns the MD5 hash of the given open file's content.
+
+        Regular files on the local disk are hashed through a read-only
+        memory map of the whole file, without copying it in chunks. Other
+        files (e.g. in memory or of remote storages) are read in chunks of
+        ``hash_chunk_size`` bytes, without asking them for a file
+        descriptor, which could have side effects.
+        """
+        md5 = md5_constructor()
+        content_map = None
+        raw_file = getattr(content, 'file', content)
+        if isinstance(raw_file, file):
+            try:
+                fileno = raw_file.fileno()
+                if stat.S_ISREG(os.fstat(fileno).st_mode):
+                    content_map = mmap.mmap(fileno, 0,
+                                            access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, mmap.error):
+                # e.g. empty files, which can't be mapped
+                pass
+        if content_map is None:
+            for chunk in content.chunks(self.hash_chunk_size):
+                md5.update(chunk)
+        else:
+            try:
+                md5.update(content_map)
+            finally:
+                content_map.close()
+        return md5.hexdigest()
 
     def hashed_name(self, name, content=None):
+        """
+        Returns the hashed name of the given file, hashing the given open
+        file or else opening it.
+        """
         parsed_name = urlsplit(unquote(name))
         clean_name = parsed_name.path
-        if content is None:
+        opened = content is None
+        if opened:
             if not self.exists(clean_name):
                 raise ValueError("The file '%s' could not be found with %r." %
                                  (clean_name, self))
@@ -129,10 +414,11 @@ class CachedFilesMixin(object):
         path, filename = os.path.split(clean_name)
         root, ext = os.path.splitext(filename)
         # Get the MD5 hash of the file
-        md5 = md5_constructor()
-        for chunk in content.chunks():
-            md5.update(chunk)
-        md5sum = md5.hexdigest()[:12]
+        try:
+            md5sum = self.file_hash(clean_name, content)[:12]
+        finally:
+            if opened:
+                content.close()
         hashed_name = os.path.join(path, u"%s.%s%s" %
                                    (root, md5sum, ext))
         unparsed_name = list(parsed_name)
@@ -143,25 +429,322 @@ class CachedFilesMixin(object):
             unparsed_name[2] += '?'
         return urlunsplit(unparsed_name)
 
-    def cache_key(self, name):
-        return u'staticfiles:cache:%s' % name
+    def read_manifest(self, name=None):
+        """
+        Returns the content of the manifest written by ``post_process``
+        (or of the given copy of it), or ``None`` if there is none.
+        """
+        if name is None:
+            name = self.manifest_name
+        if not self.exists(name):
+            return None
+        with self.open(name) as manifest:
+            return manifest.read()
 
-    def url(self, name, force=False):
+    def load_manifest(self, name=None):
         """
-        Returns the real URL in DEBUG mode.
+        Returns the mapping of file names to hashed names stored in the
+        manifest (empty if there is none).
         """
-        if settings.DEBUG and not force:
-            hashed_name, fragment = name, ''
+        if name is None:
+            name = self.manifest_name
+        content = self.read_manifest(name)
+        if content is None:
+            return {}
+        try:
+            stored = json.loads(content)
+        except ValueError:
+            stored = {}
+        if stored.get('version') != self.manifest_version:
+            raise ValueError("Couldn't load manifest '%s' (version %s)" %
+                             (name, self.manifest_version))
+        return stored.get('paths', {})
+
+    def save_manifest(self, hashed_names):
+        """
+        Writes the given mapping of file names to hashed names to the
+        manifest and returns the digest of its content.
+        """
+        content = json.dumps({
+            'version': self.manifest_version,
+            'paths': hashed_names,
+        }, sort_keys=True, separators=(',', ':'))
+        if self.exists(self.manifest_name):
+            self.delete(self.manifest_name)
+        self._save(self.manifest_name, ContentFile(smart_str(content)))
+        self.save_compact_manifest(hashed_names)
+        version = md5_constructor(smart_str(content)).hexdigest()[:12]
+
+        # keep a hashed copy of it and its name in the manifest history,
+        # to know which files the previous releases refer to
+        root, ext = os.path.splitext(self.manifest_name)
+        copy_name = u'%s.%s%s' % (root, version, ext)
+        if not self.exists(copy_name):
+            self._save(copy_name, ContentFile(smart_str(content)))
+        history = [name for name in self.load_manifest_history()
+                   if name != copy_name]
+        self.save_manifest_history(history + [copy_name])
+        return version
+
+    def load_manifest_history(self):
+        """
+        Returns the names of the copies of the manifests written by
+        ``post_process``, oldest first.
+        """
+        if not self.exists(self.manifest_history_name):
+            return []
+        try:
+            with self.open(self.manifest_history_name) as history:
+                stored = json.loads(history.read())
+        except ValueError:
+            return []
+        if stored.get('version') != self.manifest_version:
+            return []
+        return stored.get('manifests', [])
+
+    def save_manifest_history(self, names):
+        """
+        Writes the given names of manifest copies to the manifest history.
+        """
+        content = json.dumps({
+            'version': self.manifest_version,
+            'manifests': names,
+        }, separators=(',', ':'))
+        if self.exists(self.manifest_history_name):
+            self.delete(self.manifest_history_name)
+        self._save(self.manifest_history_name,
+                   ContentFile(smart_str(content)))
+
+    def stale_files(self, keep):
+        """
+        Returns the names of the hashed files which none of the last
+        ``keep`` manifests in the manifest history refer to, including their
+        precompressed variants and the copies of the older manifests.
+
+        Nothing is stale while the history has fewer manifests, since the
+        files of the releases before it are unknown.
+        """
+        history = self.load_manifest_history()
+        if keep < 1 or len(history) < keep:
+            return []
+        referenced = set()
+        for name in history[-keep:]:
+            paths = self.load_manifest(name)
+            referenced.add(name)
+            referenced.update(paths.keys())
+            referenced.update(paths.values())
+        stale = []
+        for name in get_files(self):
+            name = name.replace('\\', '/')
+            original_name = get_original_name(name)
+            if (get_name_hash(original_name) and
+                    original_name not in referenced):
+                stale.append(name)
+        return stale
+
+    def is_internal(self, name):
+        """
+        Checks if the given file is one of the manifests written by
+        ``post_process`` or a copy of one, rather than a collected file.
+        """
+        if name in (self.manifest_name, self.compact_manifest_name,
+                    self.processed_manifest_name, self.manifest_history_name):
+            return True
+        name_hash = get_name_hash(name)
+        root, ext = os.path.splitext(self.manifest_name)
+        return (name_hash is not None and
+                name == u'%s.%s%s' % (root, name_hash, ext))
+
+    def load_processed_manifest(self):
+        """
+        Returns the state of the files at the end of the previous
+        ``post_process`` run, mapping the file names to the state of their
+        source, their hashed name, the hashed names of the files they refer
+        to and their saved name (empty if there is none, or if the files
+        were processed with other settings, see ``processing_fingerprint``).
+        """
+        if not self.exists(self.processed_manifest_name):
+            return {}
+        try:
+            with self.open(self.processed_manifest_name) as manifest:
+                stored = json.loads(manifest.read())
+        except ValueError:
+            return {}
+        if (stored.get('version') != self.manifest_version or
+                stored.get('fingerprint') != self.processing_fingerprint()):
+            return {}
+        return stored.get('files', {})
+
+    def save_processed_manifest(self, files):
+        """
+        Writes the given state of the post-processed files, as returned
+        by ``load_processed_manifest``.
+        """
+        content = json.dumps({
+            'version': self.manifest_version,
+            'fingerprint': self.processing_fingerprint(),
+            'files': files,
+        }, sort_keys=True, separators=(',', ':'))
+        if self.exists(self.processed_manifest_name):
+            self.delete(self.processed_manifest_name)
+        self._save(self.processed_manifest_name,
+                   ContentFile(smart_str(content)))
+
+    def processing_fingerprint(self):
+        """
+        Returns a digest of what, besides the files, the content of the
+        adjusted files depends on: the storage class, its base URL and the
+        patterns and templates used to replace the references.
+        """
+        state = (
+            '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+            getattr(self, 'base_url', None),
+            self.patterns,
+            self.skipped_patterns,
+            self.default_template,
+        )
+        return md5_constructor(smart_str(repr(state))).hexdigest()[:12]
+
+    def source_state(self, storage, path):
+        """
+        Returns the size and modification time of the given source file,
+        or ``None`` if the storage doesn't know them.
+        """
+        try:
+            return [storage.size(path),
+                    storage.modified_time(path).isoformat()]
+        except (NotImplementedError, EnvironmentError):
+            return None
+
+    def save_compact_manifest(self, hashed_names):
+        """
+        Writes the given mapping to the compact manifest, replacing it
+        atomically on the local file system.
+        """
+        content = CompactManifest.dumps(hashed_names)
+        try:
+            path = self.path(self.compact_manifest_name)
+        except NotImplementedError:
+            if self.exists(self.compact_manifest_name):
+                self.delete(self.compact_manifest_name)
+            self._save(self.compact_manifest_name, ContentFile(content))
         else:
-            clean_name, fragment = urldefrag(name)
-            cache_key = self.cache_key(name)
+            temp_path = '%s.%s.tmp' % (path, os.getpid())
+            with open(temp_path, 'wb') as manifest:
+                manifest.write(content)
+            os.rename(temp_path, path)
+        self._compact_manifest = None
+
+    def get_compact_manifest(self):
+        """
+        Returns the memory-mapped ``CompactManifest`` of the storage, or
+        ``None`` if there is none (e.g. on a remote storage). It's only
+        opened once, the first time it's needed.
+        """
+        if self._compact_manifest is None:
+            self._compact_manifest = False
+            try:
+                path = self.path(self.compact_manifest_name)
+                self._compact_manifest = CompactManifest(path)
+            except (NotImplementedError, EnvironmentError, ValueError):
+                pass
+        return self._compact_manifest or None
+
+    def cache_version(self):
+        """
+        Returns the version the cache keys are namespaced with, either the
+        STATICFILES_CACHE_VERSION setting or the digest of the manifest
+        (or an empty string if there is neither), so that different
+        releases sharing a cache don't overwrite each other's entries.
+        """
+        version = settings.STATICFILES_CACHE_VERSION
+        if version is not None:
+            return version
+        if self._cache_version is None:
+            content = self.read_manifest()
+            if content is None:
+                self._cache_version = ''
+            else:
+                self._cache_version = md5_constructor(
+                    content).hexdigest()[:12]
+        return self._cache_version
+
+    def cache_key(self, name, version=None):
+        if version is None:
+            version = self.cache_version()
+        if version:
+            return u'staticfiles:cache:%s:%s' % (version, name)
+        return u'staticfiles:cache:%s' % name
+
+    def cached_hashed_name(self, name, cache_key):
+        """
+        Returns the hashed name of the given file after a cache miss.
+
+        Only one thread of the process hashes the file at a time, the others
+        wait for it and reuse its result (a fixed number of locks is shared
+        by all files, so they may wait for another file, too). If the
+        STATICFILES_CACHE_LOCK_TIMEOUT setting is set, a lock in the cache
+        does the same for the processes sharing the cache, for at most that
+        many seconds.
+        """
+        lock = _hashing_locks[hash(cache_key) % len(_hashing_locks)]
+        lock.acquire()
+        try:
+            # another thread might have hashed the file in the meantime
             hashed_name = self.cache.get(cache_key)
-            if hashed_name is None:
+            if hashed_name is not None:
+                return hashed_name
+            timeout = settings.STATICFILES_CACHE_LOCK_TIMEOUT
+            lock_key = u'%s:lock' % cache_key
+            locked = False
+            if timeout:
+                locked = self.cache.add(lock_key, 1, timeout)
+                if not locked:
+                    # wait for the other process to set the cache
+                    deadline = time.time() + timeout
+                    while time.time() < deadline:
+                        time.sleep(0.05)
+                        hashed_name = self.cache.get(cache_key)
+                        if hashed_name is not None:
+                            return hashed_name
+            try:
+                clean_name, fragment = urldefrag(name)
                 hashed_name = self.hashed_name(clean_name).replace('\\', '/')
                 # set the cache if there was a miss
                 # (e.g. if cache server goes down)
                 self.cache.set(cache_key, hashed_name)
+            finally:
+                if locked:
+                    self.cache.delete(lock_key)
+            return hashed_name
+        finally:
+            lock.release()
+
+    def url(self, name, force=False):
+        """
+        Returns the real URL in DEBUG mode.
+        """
+        if settings.DEBUG and not force:
+            return self._hashed_url(name, name, '')
+        clean_name, fragment = urldefrag(name)
+        cache_key = self.cache_key(name)
+        hashed_name = self.cache.get(cache_key)
+        if hashed_name is None:
+            # look the name up in the manifest before hashing the file
+            manifest = self.get_compact_manifest()
+            if manifest is not None and '?' not in clean_name:
+                hashed_name = manifest.get(clean_name)
+            if hashed_name is not None:
+                self.cache.set(cache_key, hashed_name)
+            else:
+                hashed_name = self.cached_hashed_name(name, cache_key)
+        return self._hashed_url(name, hashed_name, fragment)
 
+    def _hashed_url(self, name, hashed_name, fragment):
+        """
+        Returns the URL of the given hashed name of the given file name,
+        keeping the fragment.
+        """
         final_url = super(CachedFilesMixin, self).url(hashed_name)
 
         # Special casing for a @font-face hack, like url(myfont.eot?#iefix")
@@ -177,9 +760,49 @@ class CachedFilesMixin(object):
 
         return unquote(final_url)
 
-    def url_converter(self, name):
+    def reference_name(self, name, url):
+        """
+        Returns the name of the file the given URL found in the given file
+        refers to, or ``None`` if it's a fragment, data URI or external URL.
+        """
+        # Completely ignore http(s) prefixed URLs,
+        # fragments and data-uri URLs
+        if url.startswith(('#', 'http:', 'https:', 'data:', '//')):
+            return None
+        name_parts = name.split(os.sep)
+        # Using posix normpath here to remove duplicates
+        url = posixpath.normpath(url)
+        # Absolute URLs below the storage's base URL, e.g. /static/js/x.js
+        base_path = urlsplit(getattr(self, 'base_url', None) or '').path
+        if (base_path.startswith('/') and base_path.endswith('/') and
+                url.startswith(base_path)):
+            return unquote(url[len(base_path):])
+        url_parts = url.split('/')
+        parent_level, sub_level = url.count('..'), url.count('/')
+        if url.startswith('/'):
+            sub_level -= 1
+            url_parts = url_parts[1:]
+        if parent_level or not url.startswith('/'):
+            start, end = parent_level + 1, parent_level
+        else:
+            if sub_level:
+                if sub_level == 1:
+                    parent_level -= 1
+                start, end = parent_level, sub_level - 1
+            else:
+                start, end = 1, sub_level - 1
+        joined_result = '/'.join(name_parts[:-start] + url_parts[end:])
+        return unquote(joined_result)
+
+    def url_converter(self, name, hashed_names=None):
         """
         Returns the custom URL converter for the given file name.
+
+        The optional ``hashed_names`` mapping of file names to hashed names
+        is used for the referenced files found in it, e.g. those already
+        post-processed. If it's given, the other referenced files are hashed
+        instead of looking their hashed names up in the manifest and the
+        cache, which still refer to the previous post-processing run.
         """
         def converter(matchobj):
             """
@@ -187,35 +810,81 @@ class CachedFilesMixin(object):
             and returns the normalized and hashed URL using the url method
             of the storage.
             """
-            matched, url = matchobj.groups()
-            # Completely ignore http(s) prefixed URLs,
-            # fragments and data-uri URLs
-            if url.startswith(('#', 'http:', 'https:', 'data:')):
+            matched, url = matchobj.group(1, 2)
+            reference_name = self.reference_name(name, url)
+            if reference_name is None:
                 return matched
-            name_parts = name.split(os.sep)
-            # Using posix normpath here to remove duplicates
-            url = posixpath.normpath(url)
-            url_parts = url.split('/')
-            parent_level, sub_level = url.count('..'), url.count('/')
-            if url.startswith('/'):
-                sub_level -= 1
-                url_parts = url_parts[1:]
-            if parent_level or not url.startswith('/'):
-                start, end = parent_level + 1, parent_level
+            clean_name, fragment = urldefrag(reference_name)
+            if (hashed_names is not None and '?' not in clean_name and
+                    clean_name in hashed_names):
+                hashed_url = self._hashed_url(
+                    reference_name, hashed_names[clean_name], fragment)
             else:
-                if sub_level:
-                    if sub_level == 1:
-                        parent_level -= 1
-                    start, end = parent_level, sub_level - 1
-                else:
-                    start, end = 1, sub_level - 1
-            joined_result = '/'.join(name_parts[:-start] + url_parts[end:])
-            hashed_url = self.url(unquote(joined_result), force=True)
+                try:
+                    if hashed_names is None:
+                        hashed_url = self.url(reference_name, force=True)
+                    else:
+                        # e.g. files referring to each other
+                        hashed_name = self.hashed_name(clean_name)
+                        hashed_url = self._hashed_url(
+                            reference_name, hashed_name.replace('\\', '/'),
+                            fragment)
+                except ValueError:
+                    if not matches_patterns(name,
+                                            self.ignore_missing_patterns):
+                        raise
+                    return matched
 
             # Return the hashed and normalized version to the file
-            return 'url("%s")' % unquote(hashed_url)
+            template = self._templates.get(matchobj.re,
+                                           self.default_template)
+            if template is None:
+                # only replace the URL in the matched text
+                start = matchobj.start(1)
+                return (matched[:matchobj.start(2) - start] +
+                        unquote(hashed_url) +
+                        matched[matchobj.end(2) - start:])
+            return template % unquote(hashed_url)
         return converter
 
+    def get_rewriter(self, name):
+        """
+        Returns the ``StreamRewriter`` for the references in the given
+        file, or ``None`` if no patterns apply to it.
+        """
+        for extension, rewriter in self._rewriters.items():
+            if matches_patterns(name, [extension]):
+                return rewriter
+        return None
+
+    def is_adjustable(self, name):
+        """
+        Checks if the references in the given file are adjusted, so that
+        its content changes with the hashed names of the files it refers
+        to while its own hashed name stays the same.
+        """
+        return self.get_rewriter(name) is not None
+
+    def references(self, name, content):
+        """
+        Returns the names of the files referenced in the given content of
+        the given file.
+        """
+        rewriter = self.get_rewriter(name)
+        names = []
+        if rewriter is None:
+            return names
+
+        def collect(matchobj):
+            reference_name = self.reference_name(name, matchobj.group(2))
+            if reference_name is not None:
+                clean_name = urlsplit(reference_name).path
+                if clean_name not in names:
+                    names.append(clean_name)
+            return ''
+        rewriter.rewrite(content, lambda text: None, collect)
+        return names
+
     def post_process(self, paths, dry_run=False, **options):
         """
         Post process the given list of files (called from collectstatic).
@@ -229,21 +898,97 @@ class CachedFilesMixin(object):
 
         If either of these are performed on a file, then that file is considered
         post-processed.
+
+        Files whose source and referenced files haven't changed since the
+        previous run (as recorded in the processed manifest) are neither
+        saved nor adjusted again.
+
+        The ``hashed_names`` and ``references`` options can be used to
+        share the hashed names of the files and the references found in
+        the adjustable files between storages post-processing the same
+        files, so that each file is only hashed and scanned once.
         """
         # don't even dare to process the files if we're in dry run mode
         if dry_run:
             return
 
         # where to store the new paths
-        hashed_paths = {}
+        processed_names = {}
+
+        # the names already hashed (e.g. by another storage)
+        hashed_names = options.get('hashed_names')
+        if hashed_names is None:
+            hashed_names = {}
+
+        # the references already found in the adjustable files
+        found_references = options.get('references')
+        if found_references is None:
+            found_references = {}
 
         # build a list of adjustable files
-        matches = lambda path: matches_patterns(path, self._patterns.keys())
-        adjustable_paths = [path for path in paths if matches(path)]
+        adjustable_paths = [path for path in paths if self.is_adjustable(path)]
 
         # then sort the files by the directory level
         path_level = lambda name: len(name.split(os.sep))
-        for name in sorted(paths.keys(), key=path_level, reverse=True):
+        names = sorted(paths.keys(), key=path_level, reverse=True)
+
+        # reuse the hashed names of the files unchanged since the last run
+        previous = self.load_processed_manifest()
+        processed_files, unchanged, sources = {}, {}, {}
+        for name in names:
+            storage, path = paths[name]
+            sources[name] = self.source_state(storage, path)
+            entry = previous.get(name.replace('\\', '/'))
+            if (entry and sources[name] is not None and
+                    entry.get('source') == sources[name]):
+                # confirm the digest, the size and modification time stay
+                # the same for some edits (e.g. copied with their times)
+                if name not in hashed_names:
+                    with storage.open(path) as original_file:
+                        hashed_names[name] = self.hashed_name(
+                            name, original_file)
+                if hashed_names[name] == entry['hashed_name']:
+                    unchanged[name] = entry
+
+        # and save the files the adjustable files refer to before them
+        url_names = dict([(name.replace('\\', '/'), name) for name in paths])
+        references = {}
+        for name in adjustable_paths:
+            if name in found_references:
+                found = found_references[name]
+            elif name in unchanged and 'found' in unchanged[name]:
+                found = unchanged[name]['found']
+            else:
+                storage, path = paths[name]
+                with storage.open(path) as original_file:
+                    found = self.references(name, original_file)
+            found_references[name] = found
+            references[name] = [url_names[reference] for reference in found
+                                if reference in url_names]
+        names = dependency_order(names,
+                                 lambda name: references.get(name, ()))
+
+        for name in names:
+            url_name = name.replace('\\', '/')
+            # the hashed names of the referenced files, as adjusted
+            dependencies = dict([
+                (reference.replace('\\', '/'),
+                 processed_names.get(reference.replace('\\', '/')))
+                for reference in references.get(name, ())])
+            entry = unchanged.get(name)
+            if (entry is not None and
+                    entry.get('references', {}) == dependencies and
+                    None not in dependencies.values() and
+                    self.exists(entry['saved_name'])):
+                # neither the file nor the files it refers to changed
+                # (files referring to each other are always adjusted)
+                hashed_name = entry['saved_name']
+                processed_names[url_name] = hashed_name
+                if name in found_references:
+                    entry['found'] = found_references[name]
+                processed_files[url_name] = entry
+                yield name, hashed_name, False
+                continue
 
             # use the original, local file, not the copied-but-unprocessed
             # file, which might be somewhere far away, like S3
@@ -252,7 +997,9 @@ class CachedFilesMixin(object):
 
                 # generate the hash with the original content, even for
                 # adjustable files.
-                hashed_name = self.hashed_name(name, original_file)
+                if name not in hashed_names:
+                    hashed_names[name] = self.hashed_name(name, original_file)
+                hashed_name = hashed_names[name]
 
                 # then get the original's file content..
                 if hasattr(original_file, 'seek'):
@@ -261,18 +1008,24 @@ class CachedFilesMixin(object):
                 hashed_file_exists = self.exists(hashed_name)
                 processed = False
 
-                # ..to apply each replacement pattern to the content
+                # ..to apply the replacement patterns to the content in a
+                # single pass, streaming the result to a temporary file
                 if name in adjustable_paths:
-                    content = original_file.read()
-                    converter = self.url_converter(name)
-                    for patterns in self._patterns.values():
-                        for pattern in patterns:
-                            content = pattern.sub(converter, content)
-                    if hashed_file_exists:
-                        self.delete(hashed_name)
-                    # then save the processed result
-                    content_file = ContentFile(smart_str(content))
-                    saved_name = self._save(hashed_name, content_file)
+                    converter = self.url_converter(name, processed_names)
+                    temp_file = tempfile.TemporaryFile()
+                    try:
+                        self.get_rewriter(name).rewrite(
+                            original_file,
+                            lambda text: temp_file.write(smart_str(text)),
+                            converter)
+                        if hashed_file_exists:
+                            self.delete(hashed_name)
+                        # then save the processed result
+                        content_file = File(temp_file)
+                        content_file.size = temp_file.tell()
+                        saved_name = self._save(hashed_name, content_file)
+                    finally:
+                        temp_file.close()
                     hashed_name = force_unicode(saved_name.replace('\\', '/'))
                     processed = True
                 else:
@@ -283,10 +1036,27 @@ class CachedFilesMixin(object):
                         saved_name = self._save(hashed_name, original_file)
                         hashed_name = force_unicode(saved_name.replace('\\', '/'))
 
-                # and then set the cache accordingly
-                hashed_paths[self.cache_key(name)] = hashed_name
+                processed_names[url_name] = hashed_name
+                processed_files[url_name] = {
+                    'source': sources[name],
+                    'hashed_name': hashed_names[name],
+                    'references': dependencies,
+                    'saved_name': hashed_name,
+                }
+                if name in found_references:
+                    # all names found, to notice referenced files added later
+                    processed_files[url_name]['found'] = found_references[name]
                 yield name, hashed_name, processed
 
+        # write the manifests and set the cache under its version
+        self.save_processed_manifest(processed_files)
+        version = self.save_manifest(processed_names)
+        if settings.STATICFILES_CACHE_VERSION is None:
+            self._cache_version = version
+        version = self.cache_version()
+        hashed_paths = {}
+        for name, hashed_name in processed_names.iteritems():
+            hashed_paths[self.cache_key(name, version)] = hashed_name
         self.cache.set_many(hashed_paths)
 
 
@@ -317,9 +1087,8 @@ class AppStaticStorage(TimeAwareFileSystemStorage):
         if self.app_module == 'django.contrib.admin' and VERSION[:2] < (1, 4):
             self.prefix = 'admin'
             self.source_dir = 'media'
-        mod = import_module(self.app_module)
-        mod_path = os.path.dirname(mod.__file__)
-        location = os.path.join(mod_path, self.source_dir)
+        location = os.path.join(get_app_path(self.app_module),
+                                self.source_dir)
         super(AppStaticStorage, self).__init__(location, *args, **kwargs)
 
 
@@ -0,0 +1,69 @@
+"""
+Micro-benchmark of the URL rewriting of the ``CachedStaticFilesStorage``,
+comparing the single-pass ``StreamRewriter`` with applying each of the
+previous patterns one after the other. Run it with::
+
+    make benchmark
+
+or::
+
+    DJANGO_SETTINGS_MODULE=staticfiles.test_settings \\
+        python -m staticfiles.tests.benchmarks
+"""
+import re
+import sys
+import timeit
+from cStringIO import StringIO
+
+from staticfiles.storage import CachedFilesMixin
+from staticfiles.utils import StreamRewriter
+
+SEQUENTIAL_PATTERNS = (
+    r"""(url\(['"]{0,1}\s*(.*?)["']{0,1}\))""",
+    r"""(@import\s*["']\s*(.*?)["'])""",
+)
+
+# A minified stylesheet with a few thousand rules on a single line
+MINIFIED_CSS = ''.join([
+    '.c%d{color:#fff;background:url("../img/i%d.png") no-repeat 0 0}'
+    '/* url(x%d.png) */.d%d:after{content:"(%d)"}' % ((i,) * 5)
+    for i in range(2000)])
+
+# Opening url( without a closing parenthesis, e.g. in a truncated file
+UNCLOSED_CSS = '.a{background:url(' * 2000
+
+
+def converter(match):
+    return match.group(1)
+
+
+def sequential(content):
+    for pattern in [re.compile(source) for source in SEQUENTIAL_PATTERNS]:
+        content = pattern.sub(converter, content)
+    return content
+
+
+def single_pass(content):
+    patterns = [re.compile(pattern)
+                for pattern, template in CachedFilesMixin.patterns[0][1]]
+    skipped_patterns = [re.compile(pattern)
+                        for pattern in CachedFilesMixin.skipped_patterns[0][1]]
+    output = StringIO()
+    StreamRewriter(patterns, skipped_patterns).rewrite(
+        StringIO(content), output.write, converter)
+    return output.getvalue()
+
+
+def main(number=5):
+    for label, content in (('minified', MINIFIED_CSS),
+                           ('unclosed', UNCLOSED_CSS)):
+        for function in (sequential, single_pass):
+            duration = min(timeit.repeat(lambda: function(content),
+                                         repeat=3, number=number)) / number
+            sys.stdout.write('%-10s %-12s %8d bytes %10.2f ms\n' %
+                             (label, function.__name__, len(content),
+                              duration * 1000))
+
+
+if __name__ == '__main__':
+    main()
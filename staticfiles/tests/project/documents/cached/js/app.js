@@ -0,0 +1,9 @@
+import { helper } from "./util.js";
+import defaults from 'lodash';
+import { x } from './lib/helper';
+export * from './util.js';
+var message = "import './missing.js'";
+// import "./missing.js"
+/* import "./missing.js" */
+helper(message);
+//# sourceMappingURL=app.js.map
@@ -0,0 +1 @@
+export function helper(message) {}
@@ -1,31 +1,45 @@
 # -*- encoding: utf-8 -*-
 from __future__ import with_statement
 import codecs
+import gzip
 import os
 import stat
 import posixpath
+import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import unittest2
 from StringIO import StringIO
+from wsgiref.util import FileWrapper
 
 from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import default_storage
+from django.core.handlers.wsgi import WSGIHandler
 from django.core.management import call_command
+from django.core.signals import request_started
 from django.template import loader, Context
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import simplejson as json
+from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_unicode
+from django.utils.hashcompat import md5_constructor
 
 try:
     from django.utils.functional import empty
 except ImportError:
     empty = None  # noqa
 
-from staticfiles import finders, storage
+from staticfiles import finders, storage, views
 from staticfiles.conf import settings
+from staticfiles.handlers import StaticFilesHandler, StaticRootHandler
 from staticfiles.management.commands.collectstatic import Command as \
     CollectstaticCommand
+from staticfiles.utils import dependency_order, LRUCache, StreamRewriter
 
 
 def rmtree_errorhandler(func, path, exc_info):
@@ -234,6 +248,44 @@ class TestFindStatic(CollectionTestCase, TestDefaults):
         self.assertTrue('project' in lines[1])
         self.assertTrue('apps' in lines[2])
 
+    def _find_json(self, *args, **kwargs):
+        _stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            call_command('findstatic', json=True, verbosity='0',
+                         *args, **kwargs)
+            return json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = _stdout
+
+    def test_json(self):
+        """
+        Test that findstatic --json returns the matches of all paths.
+        """
+        results = self._find_json('test/file.txt', 'does/not/exist')
+        self.assertEqual(len(results['test/file.txt']), 2)
+        self.assertTrue('project' in results['test/file.txt'][0])
+        self.assertTrue('apps' in results['test/file.txt'][1])
+        self.assertEqual(results['does/not/exist'], [])
+        results = self._find_json('test/file.txt', 'does/not/exist',
+                                  all=False)
+        self.assertTrue('project' in results['test/file.txt'])
+        self.assertEqual(results['does/not/exist'], None)
+
+    def test_stdin(self):
+        """
+        Test that findstatic --stdin reads the paths from standard input.
+        """
+        _stdin = sys.stdin
+        sys.stdin = StringIO('test/file.txt\n\nprefix/test.txt\n')
+        try:
+            results = self._find_json(stdin=True)
+        finally:
+            sys.stdin = _stdin
+        self.assertEqual(sorted(results.keys()),
+                         ['prefix/test.txt', 'test/file.txt'])
+        self.assertEqual(len(results['prefix/test.txt']), 1)
+
 
 class TestCollection(CollectionTestCase, TestDefaults):
     """
@@ -266,6 +318,130 @@ class TestCollection(CollectionTestCase, TestDefaults):
         self.assertFileNotFound('ignored/test_directory.txt')
 
 
+class TestCollectionReportDuplicates(CollectionTestCase):
+    """
+    Test the ``--report-duplicates`` option of the ``collectstatic``
+    management command.
+    """
+    def run_collectstatic(self):
+        self.output = StringIO()
+        call_command('collectstatic', interactive=False, verbosity='1',
+                     report_duplicates=True, stdout=self.output)
+
+    def test_no_files_collected(self):
+        self.assertEqual(os.listdir(settings.STATIC_ROOT), [])
+
+    def test_report(self):
+        output = self.output.getvalue()
+        self.assertTrue('Shadowed files:' in output)
+        self.assertTrue('Files with identical content:' in output)
+
+    def test_find_duplicates(self):
+        command = CollectstaticCommand()
+        command.set_options(interactive=False, verbosity='0', link=False,
+                            clear=False, dry_run=False, post_process=False,
+                            use_default_ignore_patterns=True,
+                            ignore_patterns=[])
+        shadowed, identical, sizes = command.find_duplicates()
+        file_path = os.path.join('test', 'file.txt')
+        self.assertEqual(shadowed.keys(), [file_path])
+        self.assertTrue('project' in shadowed[file_path][0])
+        self.assertTrue('apps' in shadowed[file_path][1])
+        images = [os.path.join(settings.TEST_ROOT, 'project', 'documents',
+                               'cached', 'css', 'img', 'window.png'),
+                  os.path.join(settings.TEST_ROOT, 'project', 'documents',
+                               'cached', 'img', 'relative.png')]
+        self.assertTrue(images in identical)
+
+
+class TestCollectionMultipleStorages(CollectionTestCase, TestDefaults):
+    """
+    Test collecting to more than one destination storage.
+    """
+    def run_collectstatic(self):
+        self.other_root = tempfile.mkdtemp(prefix='staticfiles_other_')
+        self.stats = self.collect()
+
+    def tearDown(self):
+        shutil.rmtree(self.other_root, ignore_errors=True,
+                      onerror=rmtree_errorhandler)
+        super(TestCollectionMultipleStorages, self).tearDown()
+
+    def collect(self):
+        command = CollectstaticCommand()
+        command.set_options(interactive=False, verbosity='0', link=False,
+                            clear=False, dry_run=False, post_process=True,
+                            use_default_ignore_patterns=True,
+                            ignore_patterns=['*.ignoreme'])
+        return command.collect(storages=[
+            storage.StaticFilesStorage(),
+            storage.StaticFilesStorage(location=self.other_root)])
+
+    def test_other_storage(self):
+        self.assertEqual(
+            self._get_file('test.txt'),
+            codecs.open(os.path.join(self.other_root, 'test.txt'),
+                        'r', 'utf-8').read())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.other_root, 'prefix', 'test.txt')))
+
+    def test_skipped_per_storage(self):
+        os.unlink(os.path.join(self.other_root, 'test.txt'))
+        stats = self.collect()
+        self.assertEqual(stats['modified'], ['test.txt'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.other_root, 'test.txt')))
+        self.assertTrue(os.path.join('subdir', 'test.txt')
+                        in stats['unmodified'])
+
+    def test_source_opened_once(self):
+        opened = []
+        old_open = storage.TimeAwareFileSystemStorage.open
+
+        def open(self, name, mode='rb'):
+            opened.append(self.path(name))
+            return old_open(self, name, mode)
+        storage.TimeAwareFileSystemStorage.open = open
+        try:
+            command = CollectstaticCommand()
+            command.set_options(interactive=False, verbosity='0', link=False,
+                                clear=True, dry_run=False, post_process=True,
+                                use_default_ignore_patterns=True,
+                                ignore_patterns=['*.ignoreme'])
+            command.collect(storages=[
+                storage.StaticFilesStorage(),
+                storage.StaticFilesStorage(location=self.other_root)])
+        finally:
+            storage.TimeAwareFileSystemStorage.open = old_open
+        self.assertTrue(opened)
+        self.assertEqual(sorted(opened), sorted(set(opened)))
+        self.assertEqual(
+            self._get_file('test.txt'),
+            codecs.open(os.path.join(self.other_root, 'test.txt'),
+                        'r', 'utf-8').read())
+
+    def test_shared_post_processing(self):
+        scanned = []
+
+        class CountingStorage(storage.CachedStaticFilesStorage):
+            def references(self, name, content):
+                scanned.append(name)
+                return super(CountingStorage, self).references(name, content)
+
+        command = CollectstaticCommand()
+        command.set_options(interactive=False, verbosity='0', link=False,
+                            clear=True, dry_run=False, post_process=True,
+                            use_default_ignore_patterns=True,
+                            ignore_patterns=['*.ignoreme'])
+        command.collect(storages=[
+            CountingStorage(),
+            CountingStorage(location=self.other_root)])
+        self.assertTrue(os.path.join('cached', 'styles.css') in scanned)
+        self.assertEqual(sorted(scanned), sorted(set(scanned)))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.other_root, 'cached', 'styles.93b1147e8552.css')))
+
+
 class TestCollectionClear(CollectionTestCase):
     """
     Test the ``--clear`` option of the ``collectstatic`` managemenet command.
@@ -410,6 +586,279 @@ class TestCollectionCachedStorage(BaseCollectionTestCase, BaseStaticFilesTestCas
             self.assertNotIn("/static/cached/styles.css", content)
             self.assertIn("/static/cached/styles.93b1147e8552.css", content)
 
+    def test_single_flight_hashing(self):
+        """
+        Concurrent cache misses for the same name only hash the file once.
+        """
+        cached_storage = storage.staticfiles_storage
+        cache_key = cached_storage.cache_key('test/file.txt')
+        cached_storage.cache.delete(cache_key)
+        # don't use the manifest
+        cached_storage._compact_manifest = False
+        hashed = []
+        original_hashed_name = cached_storage.hashed_name
+
+        def hashed_name(name, content=None):
+            hashed.append(name)
+            time.sleep(0.1)
+            return original_hashed_name(name, content)
+        cached_storage.hashed_name = hashed_name
+        urls = []
+        try:
+            threads = [threading.Thread(target=lambda: urls.append(
+                cached_storage.url('test/file.txt'))) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            del cached_storage.hashed_name
+        self.assertEqual(hashed, ['test/file.txt'])
+        self.assertEqual(len(urls), 5)
+        self.assertEqual(len(set(urls)), 1)
+
+    def test_cache_lock(self):
+        """
+        With a lock in the cache, the hashed name set by another process
+        is waited for.
+        """
+        cached_storage = storage.staticfiles_storage
+        cache_key = cached_storage.cache_key('test/file.txt')
+        cached_storage.cache.delete(cache_key)
+        # don't use the manifest
+        cached_storage._compact_manifest = False
+        cached_storage.cache.add(u'%s:lock' % cache_key, 1, 10)
+        old_timeout = settings.STATICFILES_CACHE_LOCK_TIMEOUT
+        settings.STATICFILES_CACHE_LOCK_TIMEOUT = 10
+        timer = threading.Timer(0.1, cached_storage.cache.set,
+                                (cache_key, 'test/file.other.txt'))
+        timer.start()
+        try:
+            self.assertEqual(cached_storage.url('test/file.txt'),
+                             '/static/test/file.other.txt')
+        finally:
+            timer.join()
+            settings.STATICFILES_CACHE_LOCK_TIMEOUT = old_timeout
+            cached_storage.cache.delete(cache_key)
+            cached_storage.cache.delete(u'%s:lock' % cache_key)
+
+    def test_manifest(self):
+        cached_storage = storage.staticfiles_storage
+        manifest = cached_storage.load_manifest()
+        self.assertEqual(manifest['cached/styles.css'],
+                         'cached/styles.93b1147e8552.css')
+        self.assertEqual(manifest['test/file.txt'], 'test/file.ea5bccaf16d5.txt')
+
+    def test_cache_version(self):
+        """
+        The cache keys are namespaced with the digest of the manifest, or
+        the STATICFILES_CACHE_VERSION setting.
+        """
+        cached_storage = storage.staticfiles_storage
+        content = cached_storage.read_manifest()
+        version = md5_constructor(content).hexdigest()[:12]
+        self.assertEqual(cached_storage.cache_version(), version)
+        self.assertEqual(cached_storage.cache_key('test/file.txt'),
+                         u'staticfiles:cache:%s:test/file.txt' % version)
+        self.assertEqual(
+            cached_storage.cache.get(cached_storage.cache_key('test/file.txt')),
+            'test/file.ea5bccaf16d5.txt')
+        old_version = settings.STATICFILES_CACHE_VERSION
+        settings.STATICFILES_CACHE_VERSION = 'other'
+        try:
+            self.assertEqual(cached_storage.cache_key('test/file.txt'),
+                             u'staticfiles:cache:other:test/file.txt')
+            # entries of other versions aren't used
+            cached_storage.cache.set(
+                u'staticfiles:cache:%s:test/file.txt' % version, 'other.txt')
+            self.assertNotEqual(cached_storage.url('test/file.txt'),
+                                '/static/other.txt')
+        finally:
+            settings.STATICFILES_CACHE_VERSION = old_version
+
+    def test_warm_cache(self):
+        cached_storage = storage.staticfiles_storage
+        cache_key = cached_storage.cache_key('cached/styles.css')
+        cached_storage.cache.clear()
+        out = StringIO()
+        call_command('warmstaticcache', verbosity=1, stdout=out)
+        self.assertTrue(out.getvalue().startswith('Set '))
+        self.assertEqual(cached_storage.cache.get(cache_key),
+                         'cached/styles.93b1147e8552.css')
+
+    def test_warm_cache_rehash(self):
+        cached_storage = storage.staticfiles_storage
+        cache_key = cached_storage.cache_key('cached/styles.css')
+        cached_storage.cache.clear()
+        call_command('warmstaticcache', rehash=True, chunk_size=2,
+                     verbosity=0)
+        self.assertEqual(cached_storage.cache.get(cache_key),
+                         'cached/styles.93b1147e8552.css')
+        self.assertEqual(cached_storage.cache.get(cached_storage.cache_key(
+            'cached/styles.93b1147e8552.css')), None)
+
+    def test_warm_cache_rehash_collected_only(self):
+        cached_storage = storage.staticfiles_storage
+        cached_storage._save('cached/styles.css.gz', ContentFile('gzipped'))
+        cached_storage.cache.clear()
+        call_command('warmstaticcache', rehash=True, verbosity=0)
+        for name in ['cached/styles.css.gz', cached_storage.manifest_name,
+                     cached_storage.manifest_history_name] + \
+                cached_storage.load_manifest_history():
+            self.assertTrue(cached_storage.exists(name))
+            self.assertEqual(cached_storage.cache.get(
+                cached_storage.cache_key(name)), None)
+
+    def test_file_hash(self):
+        cached_storage = storage.staticfiles_storage
+        with cached_storage.open('cached/styles.css') as styles:
+            content = styles.read()
+        expected = md5_constructor(content).hexdigest()
+        # memory-mapped local file
+        with cached_storage.open('cached/styles.css') as styles:
+            self.assertEqual(cached_storage.file_hash('cached/styles.css',
+                                                      styles), expected)
+        # in-memory file without a descriptor, read in chunks
+        self.assertEqual(cached_storage.file_hash('cached/styles.css',
+                                                  ContentFile(content)),
+                         expected)
+        # spooled file, which must not be rolled over to the disk
+        spooled = tempfile.SpooledTemporaryFile(max_size=len(content) + 1)
+        try:
+            spooled.write(content)
+            spooled_file = File(spooled)
+            spooled_file.size = len(content)
+            self.assertEqual(cached_storage.file_hash('cached/styles.css',
+                                                      spooled_file),
+                             expected)
+            self.assertFalse(spooled._rolled)
+        finally:
+            spooled.close()
+        # empty files can't be memory-mapped
+        cached_storage._save('cached/empty.txt', ContentFile(''))
+        with cached_storage.open('cached/empty.txt') as empty:
+            self.assertEqual(cached_storage.file_hash('cached/empty.txt',
+                                                      empty),
+                             md5_constructor('').hexdigest())
+        self.assertEqual(cached_storage.hashed_name('cached/empty.txt'),
+                         'cached/empty.d41d8cd98f00.txt')
+
+    def test_clean_stale_files(self):
+        cached_storage = storage.staticfiles_storage
+        paths = cached_storage.load_manifest()
+        self.assertEqual(len(cached_storage.load_manifest_history()), 1)
+        current_name = paths['cached/styles.css']
+        # a previous release and a file of an even older one
+        previous = dict(paths)
+        previous['cached/styles.css'] = 'cached/styles.aaaaaaaaaaaa.css'
+        cached_storage._save('cached/styles.aaaaaaaaaaaa.css',
+                             ContentFile('previous'))
+        cached_storage._save('cached/styles.bbbbbbbbbbbb.css',
+                             ContentFile('older'))
+        cached_storage._save('cached/styles.bbbbbbbbbbbb.css.gz',
+                             ContentFile('older, gzipped'))
+        cached_storage.save_manifest(previous)
+        cached_storage.save_manifest(paths)
+        history = cached_storage.load_manifest_history()
+        self.assertEqual(len(history), 2)
+        self.assertEqual(cached_storage.load_manifest(history[-1]), paths)
+        self.assertEqual(cached_storage.stale_files(3), [])
+
+        out = StringIO()
+        call_command('cleanstatic', keep=2, dry_run=True, verbosity=1,
+                     stdout=out)
+        self.assertEqual(out.getvalue(), 'Would delete 2 stale files.\n')
+        self.assertTrue(cached_storage.exists('cached/styles.bbbbbbbbbbbb.css'))
+
+        call_command('cleanstatic', keep=2, verbosity=0)
+        self.assertFalse(cached_storage.exists('cached/styles.bbbbbbbbbbbb.css'))
+        self.assertFalse(
+            cached_storage.exists('cached/styles.bbbbbbbbbbbb.css.gz'))
+        self.assertTrue(cached_storage.exists('cached/styles.aaaaaaaaaaaa.css'))
+
+        self.assertTrue(history[0] in cached_storage.stale_files(1))
+        call_command('cleanstatic', keep=1, batch_size=1, verbosity=0)
+        self.assertFalse(cached_storage.exists('cached/styles.aaaaaaaaaaaa.css'))
+        self.assertFalse(cached_storage.exists(history[0]))
+        self.assertEqual(cached_storage.load_manifest_history(), history[-1:])
+        for name in ('cached/styles.css', current_name, history[-1],
+                     cached_storage.manifest_name):
+            self.assertTrue(cached_storage.exists(name))
+
+    def test_compact_manifest(self):
+        cached_storage = storage.staticfiles_storage
+        manifest = cached_storage.get_compact_manifest()
+        self.assertEqual(len(manifest), len(cached_storage.load_manifest()))
+        self.assertEqual(manifest.get('cached/styles.css'),
+                         'cached/styles.93b1147e8552.css')
+        self.assertEqual(manifest.get('does/not/exist.css'), None)
+        # cache misses are answered from the manifest without hashing
+        cached_storage.cache.clear()
+
+        def hashed_name(name, content=None):
+            self.fail("The file was hashed.")
+        cached_storage.hashed_name = hashed_name
+        try:
+            self.assertEqual(cached_storage.url('cached/styles.css'),
+                             '/static/cached/styles.93b1147e8552.css')
+        finally:
+            del cached_storage.hashed_name
+
+    def test_js_references(self):
+        relpath = self.cached_file_path("cached/js/app.js")
+        util_url = storage.staticfiles_storage.url("cached/js/util.js")
+        map_url = storage.staticfiles_storage.url("cached/js/app.js.map")
+        self.assertNotEqual(util_url, "/static/cached/js/util.js")
+        with storage.staticfiles_storage.open(relpath) as relfile:
+            content = relfile.read()
+            self.assertIn('import { helper } from "%s";' % util_url, content)
+            self.assertIn("export * from '%s';" % util_url, content)
+            self.assertIn("import defaults from 'lodash';", content)
+            # unresolvable references are left as they are
+            self.assertIn("import { x } from './lib/helper';", content)
+            self.assertIn("//# sourceMappingURL=%s" % map_url, content)
+            # references in strings and comments are left alone
+            self.assertEqual(content.count("./missing.js"), 3)
+
+    def test_svg_references(self):
+        relpath = self.cached_file_path("cached/img/icon.svg")
+        with storage.staticfiles_storage.open(relpath) as relfile:
+            content = relfile.read()
+            self.assertIn('xlink:href="/static/cached/img/relative.acae32e4532b.png"',
+                          content)
+            self.assertIn('<!-- <image href="missing.png"/> -->', content)
+            self.assertIn('<use href="#shape"/>', content)
+            self.assertIn('url(#gradient)', content)
+
+    def test_html_references(self):
+        relpath = self.cached_file_path("cached/fragment.html")
+        with storage.staticfiles_storage.open(relpath) as relfile:
+            content = relfile.read()
+            self.assertIn('<link rel="stylesheet" '
+                          'href="/static/cached/styles.93b1147e8552.css">',
+                          content)
+            self.assertIn('src="/static/cached/img/relative.acae32e4532b.png"',
+                          content)
+            self.assertIn('<!-- <img src="missing.png"> -->', content)
+            self.assertIn('src="{{ avatar }}"', content)
+            self.assertIn('href="/about/"', content)
+            self.assertIn('<script src="%s"></script>' %
+                          storage.staticfiles_storage.url("cached/js/util.js"),
+                          content)
+            self.assertIn('<script src="/static/js/main.js"></script>',
+                          content)
+
+    def test_references(self):
+        cached_storage = storage.staticfiles_storage
+        self.assertEqual(cached_storage.references(
+            'cached/relative.css',
+            StringIO('@import url("../cached/styles.css");\n'
+                     '@import "styles.css";\n'
+                     'body { background: url(img/relative.png?v=1#x) }')),
+            ['cached/styles.css', 'cached/img/relative.png'])
+        self.assertEqual(cached_storage.references(
+            'test/file.txt', StringIO('url(img/relative.png)')), [])
+
     def test_template_tag_denorm(self):
         relpath = self.cached_file_path("cached/denorm.css")
         self.assertEqual(relpath, "cached/denorm.363de96e9b4b.css")
@@ -462,8 +911,9 @@ class TestCollectionCachedStorage(BaseCollectionTestCase, BaseStaticFilesTestCas
     def test_post_processing(self):
         """Test that post_processing behaves correctly.
 
-        Files that are alterable should always be post-processed; files that
-        aren't should be skipped.
+        Files that are alterable should be post-processed if they or the
+        files they refer to changed since the previous run; other files
+        should be skipped.
 
         collectstatic has already been called once in setUp() for this testcase,
         therefore we check by verifying behavior on a second run.
@@ -482,9 +932,120 @@ class TestCollectionCachedStorage(BaseCollectionTestCase, BaseStaticFilesTestCas
         collectstatic_cmd = CollectstaticCommand()
         collectstatic_cmd.set_options(**collectstatic_args)
         stats = collectstatic_cmd.collect()
-        self.assertTrue(u'cached/css/window.css' in stats['post_processed'])
+        self.assertFalse(u'cached/css/window.css' in stats['post_processed'])
         self.assertTrue(u'cached/css/img/window.png' in stats['unmodified'])
 
+        # pretend the image it refers to had another hashed name before
+        cached_storage = storage.staticfiles_storage
+        files = cached_storage.load_processed_manifest()
+        files['cached/css/window.css']['references'][
+            'cached/css/img/window.png'] = 'cached/css/img/window.old.png'
+        cached_storage.save_processed_manifest(files)
+        collectstatic_cmd = CollectstaticCommand()
+        collectstatic_cmd.set_options(**collectstatic_args)
+        stats = collectstatic_cmd.collect()
+        self.assertTrue(u'cached/css/window.css' in stats['post_processed'])
+        self.assertEqual(stats['post_processed'], [u'cached/css/window.css'])
+
+    def test_post_processing_unchanged(self):
+        """
+        Files unchanged since the previous run aren't scanned or adjusted
+        again.
+        """
+        cached_storage = storage.staticfiles_storage
+        files = cached_storage.load_processed_manifest()
+        self.assertEqual(files['cached/css/window.css']['references'],
+                         {'cached/css/img/window.png':
+                          'cached/css/img/window.acae32e4532b.png'})
+        self.assertEqual(files['cached/css/window.css']['found'],
+                         ['cached/css/img/window.png'])
+        manifest = cached_storage.load_manifest()
+
+        def references(name, content):
+            self.fail("The file '%s' was scanned." % name)
+
+        saved = []
+        original_save = cached_storage._save
+
+        def _save(name, content):
+            saved.append(name)
+            return original_save(name, content)
+        cached_storage.references = references
+        cached_storage._save = _save
+        try:
+            self.run_collectstatic()
+        finally:
+            del cached_storage.references
+            del cached_storage._save
+        self.assertEqual(
+            [name for name in saved if name in manifest.values()], [])
+        self.assertEqual(cached_storage.load_manifest(), manifest)
+        self.assertEqual(cached_storage.load_processed_manifest(), files)
+
+    def test_post_processing_other_settings(self):
+        """
+        Changing the base URL processes the files again.
+        """
+        old_url = settings.STATIC_URL
+        settings.STATIC_URL = '/assets/'
+        storage.staticfiles_storage._wrapped = empty
+        try:
+            cached_storage = storage.staticfiles_storage
+            self.assertEqual(cached_storage.load_processed_manifest(), {})
+            collectstatic_cmd = CollectstaticCommand()
+            collectstatic_cmd.set_options(
+                interactive=False, verbosity='0', link=False, clear=False,
+                dry_run=False, post_process=True,
+                use_default_ignore_patterns=True,
+                ignore_patterns=['*.ignoreme'])
+            stats = collectstatic_cmd.collect()
+            self.assertTrue(u'cached/css/window.css' in
+                            stats['post_processed'])
+            name = cached_storage.load_processed_manifest()[
+                'cached/css/window.css']['saved_name']
+            with cached_storage.open(name) as window:
+                content = window.read()
+            self.assertIn('/assets/cached/css/img/window.acae32e4532b.png',
+                          content)
+        finally:
+            settings.STATIC_URL = old_url
+            storage.staticfiles_storage._wrapped = empty
+
+    def test_post_processing_not_looked_up(self):
+        """
+        Referenced files not post-processed yet are hashed, not looked up
+        in the cache (or manifest) of the previous run.
+        """
+        cached_storage = storage.staticfiles_storage
+        cached_storage.cache.set(
+            cached_storage.cache_key('cached/css/img/window.png'),
+            'cached/css/img/window.stale.png')
+        content = []
+        cached_storage.get_rewriter('cached/css/window.css').rewrite(
+            StringIO('body { background: url(img/window.png) }'),
+            content.append,
+            cached_storage.url_converter('cached/css/window.css', {}))
+        self.assertEqual(
+            ''.join(content), 'body { background: '
+            'url("/static/cached/css/img/window.acae32e4532b.png") }')
+
+    def test_adjustable_not_immutable(self):
+        """
+        Adjusted files change when the files they refer to change, so
+        only the other hashed files are served as immutable.
+        """
+        name = storage.staticfiles_storage.load_processed_manifest()[
+            'cached/css/window.css']['saved_name']
+        files = StaticRootHandler(WSGIHandler()).files
+        self.assertFalse(files[name].immutable)
+        self.assertNotEqual(files[name].etag,
+                            '"%s"' % storage.get_name_hash(name))
+        name = 'cached/css/img/window.acae32e4532b.png'
+        self.assertTrue(files[name].immutable)
+        self.assertEqual(files[name].etag, '"acae32e4532b"')
+        # the source files with their original names aren't immutable
+        self.assertFalse(files['cached/css/img/window.png'].immutable)
+
 if sys.platform != 'win32':
 
     class TestCollectionLinks(CollectionTestCase, TestDefaults):
@@ -505,6 +1066,100 @@ if sys.platform != 'win32':
             self.assertTrue(os.path.islink(os.path.join(settings.STATIC_ROOT, 'test.txt')))
 
 
+class TestPostProcessingChanges(unittest2.TestCase):
+    """
+    Test post-processing the files changed since the previous run.
+    """
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp(prefix='staticfiles_source_')
+        self.root = tempfile.mkdtemp(prefix='staticfiles_root_')
+        self.source = storage.TimeAwareFileSystemStorage(
+            location=self.source_dir)
+        self.storage = storage.CachedStaticFilesStorage(
+            location=self.root, base_url='/static/')
+
+    def tearDown(self):
+        shutil.rmtree(self.source_dir, ignore_errors=True)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, name, content):
+        path = os.path.join(self.source_dir, name)
+        with open(path, 'wb') as source_file:
+            source_file.write(content)
+        return path
+
+    def read(self, name):
+        with self.storage.open(self.storage.load_manifest()[name]) as f:
+            return f.read()
+
+    def post_process(self):
+        """
+        Copies the source files and post-processes them like collectstatic.
+        """
+        paths = {}
+        for name in os.listdir(self.source_dir):
+            if self.storage.exists(name):
+                self.storage.delete(name)
+            with self.source.open(name) as source_file:
+                self.storage.save(name, source_file)
+            paths[name] = (self.source, name)
+        list(self.storage.post_process(paths))
+        return self.storage.load_manifest()
+
+    def test_reference_added(self):
+        """
+        Files are adjusted again when a file they refer to is added.
+        """
+        self.write('a.js', 'import "./new.js";')
+        self.post_process()
+        self.assertEqual(self.read('a.js'), 'import "./new.js";')
+        self.write('new.js', 'new')
+        manifest = self.post_process()
+        self.assertEqual(self.read('a.js'),
+                         'import "/static/%s";' % manifest['new.js'])
+
+    def test_missing_reference(self):
+        """
+        Only references to missing files in JavaScript, SVG and HTML files
+        are left as they are.
+        """
+        self.write('a.css', 'body { background: url(missing.png) }')
+        self.assertRaises(ValueError, self.post_process)
+
+    def test_references_each_other(self):
+        """
+        Files referring to each other are adjusted again when either of
+        them changes.
+        """
+        self.write('a.js', 'import "./b.js";')
+        self.write('b.js', 'import "./a.js";')
+        self.post_process()
+        for name in ('a.js', 'b.js', 'a.js'):
+            with open(os.path.join(self.source_dir, name), 'ab') as f:
+                f.write('\n')
+            manifest = self.post_process()
+            self.assertEqual(self.read('a.js'),
+                             'import "/static/%s";' % manifest['b.js'] +
+                             '\n' * self.read('a.js').count('\n'))
+            self.assertEqual(self.read('b.js'),
+                             'import "/static/%s";' % manifest['a.js'] +
+                             '\n' * self.read('b.js').count('\n'))
+
+    def test_same_size_and_time(self):
+        """
+        Files changed without changing their size and modification time
+        are hashed again.
+        """
+        path = self.write('a.txt', 'one')
+        old_name = self.post_process()['a.txt']
+        times = (os.path.getatime(path), os.path.getmtime(path))
+        self.write('a.txt', 'two')
+        os.utime(path, times)
+        new_name = self.post_process()['a.txt']
+        self.assertNotEqual(new_name, old_name)
+        self.assertEqual(self.read('a.txt'), 'two')
+
+
 class TestServeStatic(StaticFilesTestCase):
     """
     Test static asset serving view.
@@ -522,6 +1177,334 @@ class TestServeStatic(StaticFilesTestCase):
         self.assertEquals(self._response(filepath).status_code, 404)
 
 
+class TestServeStaticStreaming(TestServeStatic):
+    """
+    Test that the static asset serving view streams the files.
+    """
+    def test_streaming(self):
+        response = self._response('test.txt')
+        self.assertTrue(isinstance(response.file_to_stream, FileWrapper))
+        content = response.content
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertTrue('Can we find' in content)
+
+    def test_directory(self):
+        self.assertFileNotFound('subdir')
+
+
+class TestServeStaticRanges(TestServeStatic):
+    """
+    Test the range requests of the static asset serving view.
+    """
+    def _range_response(self, byte_range, **extra):
+        return self.client.get(posixpath.join(settings.STATIC_URL, 'test.txt'),
+                               HTTP_RANGE=byte_range, **extra)
+
+    def test_single_range(self):
+        response = self._range_response('bytes=4-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, 'we')
+        self.assertEqual(response['Content-Length'], '2')
+        self.assertEqual(response['Content-Range'], 'bytes 4-5/23')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+
+    def test_open_ranges(self):
+        response = self._range_response('bytes=18-')
+        self.assertEqual(response.content, 'ile?\n')
+        self.assertEqual(response['Content-Range'], 'bytes 18-22/23')
+        response = self._range_response('bytes=-6')
+        self.assertEqual(response.content, 'file?\n')
+        response = self._range_response('bytes=20-100')
+        self.assertEqual(response['Content-Range'], 'bytes 20-22/23')
+
+    def test_multiple_ranges(self):
+        response = self._range_response('bytes=0-2, 19-21')
+        self.assertEqual(response.status_code, 206)
+        content_type, boundary = response['Content-Type'].split('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        content = response.content
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(content, (
+            '\r\n--%(b)s\r\nContent-Type: text/plain\r\n'
+            'Content-Range: bytes 0-2/23\r\n\r\nCan'
+            '\r\n--%(b)s\r\nContent-Type: text/plain\r\n'
+            'Content-Range: bytes 19-21/23\r\n\r\nle?'
+            '\r\n--%(b)s--\r\n') % {'b': boundary})
+
+    def test_unsatisfiable_range(self):
+        response = self._range_response('bytes=23-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */23')
+
+    def test_ignored_ranges(self):
+        for byte_range in ('bytes=5-2', 'lines=1-2', 'bytes=a-b', 'bytes'):
+            response = self._range_response(byte_range)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            self.assertEqual(response.content, 'Can we find this file?\n')
+
+    def test_if_range(self):
+        etag = self._response('test.txt')['ETag']
+        response = self._range_response('bytes=4-5', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response = self._range_response('bytes=4-5', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+
+
+class TestServeStaticConditional(TestServeStatic):
+    """
+    Test the conditional requests of the static asset serving view.
+    """
+    def setUp(self):
+        super(TestServeStaticConditional, self).setUp()
+        self.etag = self._response('test.txt')['ETag']
+
+    def _response_unopened(self, method='get', **extra):
+        def fail_open(*args, **kwargs):
+            self.fail("The file was opened.")
+        views.open = fail_open
+        try:
+            return getattr(self.client, method)(
+                posixpath.join(settings.STATIC_URL, 'test.txt'), **extra)
+        finally:
+            del views.open
+
+    def assertNotModified(self, **extra):
+        response = self._response_unopened(**extra)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], self.etag)
+
+    def test_head(self):
+        response = self._response_unopened('head')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['Content-Length'], '23')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self._response_unopened('head', HTTP_RANGE='bytes=0-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['Content-Length'], '5')
+        self.assertNotModified(REQUEST_METHOD='HEAD',
+                               HTTP_IF_NONE_MATCH=self.etag)
+
+    def test_strong_etag(self):
+        self.assertTrue(self.etag.startswith('"'))
+        self.assertEqual(self._response('test.txt')['ETag'], self.etag)
+
+    def test_hashed_looking_source(self):
+        """
+        Source files aren't immutable, even if their names look hashed.
+        """
+        path = os.path.join(settings.TEST_ROOT, 'project', 'documents',
+                            'test', 'file.0123456789ab.txt')
+        with open(path, 'wb') as source_file:
+            source_file.write('one')
+        try:
+            response = self._response('test/file.0123456789ab.txt')
+            self.assertNotEqual(response['ETag'], '"0123456789ab"')
+            self.assertEqual(response.get('Cache-Control'),
+                             settings.STATICFILES_CACHE_CONTROL)
+            with open(path, 'wb') as source_file:
+                source_file.write('two')
+            os.utime(path, (0, 0))
+            response = self.client.get(
+                posixpath.join(settings.STATIC_URL,
+                               'test/file.0123456789ab.txt'),
+                HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, 'two')
+        finally:
+            os.remove(path)
+
+    def test_if_none_match(self):
+        self.assertNotModified(HTTP_IF_NONE_MATCH=self.etag)
+        self.assertNotModified(HTTP_IF_NONE_MATCH='"other", W/%s' % self.etag)
+        self.assertNotModified(HTTP_IF_NONE_MATCH='*')
+
+    def test_cache_control(self):
+        old_cache_control = settings.STATICFILES_CACHE_CONTROL
+        settings.STATICFILES_CACHE_CONTROL = 'public, max-age=60'
+        try:
+            response = self._response('test.txt')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+            response = self.client.get(
+                posixpath.join(settings.STATIC_URL, 'test.txt'),
+                HTTP_IF_NONE_MATCH=self.etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        finally:
+            settings.STATICFILES_CACHE_CONTROL = old_cache_control
+
+    def test_if_none_match_changed(self):
+        response = self.client.get(
+            posixpath.join(settings.STATIC_URL, 'test.txt'),
+            HTTP_IF_NONE_MATCH='"other"',
+            HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2050 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('Can we find' in response.content)
+
+
+class TestServeStaticPrecompressed(TestServeStatic):
+    """
+    Test serving the precompressed variants of files.
+    """
+    def setUp(self):
+        super(TestServeStaticPrecompressed, self).setUp()
+        self.gzip_path = finders.find('test.txt') + '.gz'
+        gzip_file = gzip.GzipFile(self.gzip_path, 'wb')
+        try:
+            gzip_file.write('Can we find this file?\n')
+        finally:
+            gzip_file.close()
+        views._variants.clear()
+        self.old_validate = settings.STATICFILES_HANDLER_CACHE_VALIDATE
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = None
+
+    def tearDown(self):
+        super(TestServeStaticPrecompressed, self).tearDown()
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = self.old_validate
+        if os.path.exists(self.gzip_path):
+            os.remove(self.gzip_path)
+        views._variants.clear()
+
+    def _gzip_response(self, accept_encoding, **extra):
+        return self.client.get(posixpath.join(settings.STATIC_URL, 'test.txt'),
+                               HTTP_ACCEPT_ENCODING=accept_encoding, **extra)
+
+    def test_gzip(self):
+        response = self._gzip_response('gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        content = response.content
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(content, open(self.gzip_path, 'rb').read())
+
+    def test_identity(self):
+        for accept_encoding in ('', 'deflate', 'gzip;q=0', '*;q=0'):
+            response = self._gzip_response(accept_encoding)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.content, 'Can we find this file?\n')
+
+    def test_variant_etag(self):
+        etag = self._gzip_response('gzip')['ETag']
+        self.assertNotEqual(self._gzip_response('')['ETag'], etag)
+        response = self._gzip_response('gzip', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        response = self._gzip_response('identity', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def _write_gzip(self, content):
+        gzip_file = gzip.GzipFile(self.gzip_path, 'wb')
+        try:
+            gzip_file.write(content)
+        finally:
+            gzip_file.close()
+        os.utime(self.gzip_path, (0, 0))
+
+    def test_variants_remembered(self):
+        self._gzip_response('gzip')
+        self._write_gzip('Can we find this regenerated file?\n')
+
+        old_stat = os.stat
+
+        def stat(path):
+            if path.endswith('.gz'):
+                self.fail("The variants were looked for again.")
+            return old_stat(path)
+        os.stat = stat
+        try:
+            response = self._gzip_response('gzip')
+        finally:
+            os.stat = old_stat
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_variant_deleted(self):
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = 0
+        self._gzip_response('gzip')
+        os.remove(self.gzip_path)
+        response = self._gzip_response('gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertFalse(response.has_header('Vary'))
+        self.assertEqual(response.content, 'Can we find this file?\n')
+
+    def test_variant_added(self):
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = 0
+        os.remove(self.gzip_path)
+        self.assertFalse(self._gzip_response('gzip').has_header('Vary'))
+        self._write_gzip('Can we find this file?\n')
+        response = self._gzip_response('gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content, open(self.gzip_path, 'rb').read())
+
+    def test_variant_changed(self):
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = 0
+        self._gzip_response('gzip')
+        self._write_gzip('Can we find this regenerated file?\n')
+        response = self._gzip_response('gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = response.content
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(content, open(self.gzip_path, 'rb').read())
+
+
+class TestServeStaticMisses(TestServeStatic):
+    """
+    Test that the static asset serving view remembers missing files.
+    """
+    def setUp(self):
+        super(TestServeStaticMisses, self).setUp()
+        self.filepath = os.path.join(
+            os.path.dirname(finders.find('test.txt')), 'missing.txt')
+        self.lookups = []
+        self.old_find = finders.find
+        self.old_validate = settings.STATICFILES_MISSES_VALIDATE
+        settings.STATICFILES_MISSES_VALIDATE = 0
+
+        def find(path, all=False):
+            self.lookups.append(path)
+            return self.old_find(path, all)
+        finders.find = find
+        views._misses.clear()
+
+    def tearDown(self):
+        super(TestServeStaticMisses, self).tearDown()
+        finders.find = self.old_find
+        settings.STATICFILES_MISSES_VALIDATE = self.old_validate
+        views._misses.clear()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def test_misses(self):
+        self.assertFileNotFound('missing.txt')
+        self.assertFileNotFound('missing.txt')
+        self.assertEqual(self.lookups, ['missing.txt'])
+
+    def test_invalidation(self):
+        self.assertFileNotFound('missing.txt')
+        f = open(self.filepath, 'wb')
+        try:
+            f.write('found')
+        finally:
+            f.close()
+        # make sure the directory looks modified on coarse file systems
+        os.utime(os.path.dirname(self.filepath), (0, 0))
+        self.assertFileContains('missing.txt', 'found')
+
+    def test_other_directory_changed(self):
+        """
+        Only the directories the missing file would be in are checked.
+        """
+        self.assertFileNotFound('missing.txt')
+        os.utime(os.path.dirname(self.old_find('test/file.txt')), (0, 0))
+        self.assertFileNotFound('missing.txt')
+        self.assertEqual(self.lookups, ['missing.txt'])
+
+
 class TestServeDisabled(TestServeStatic):
     """
     Test serving static files disabled when DEBUG is False.
@@ -565,6 +1548,430 @@ class TestServeAdminMedia(TestServeStatic):
         self.assertFileContains('css/base.css', 'body')
 
 
+class TestStaticFilesHandlerCache(StaticFilesTestCase):
+    """
+    Test that the ``StaticFilesHandler`` keeps small files in memory.
+    """
+    urls = 'staticfiles.tests.urls.empty'
+
+    def setUp(self):
+        super(TestStaticFilesHandlerCache, self).setUp()
+        self.old_validate = settings.STATICFILES_HANDLER_CACHE_VALIDATE
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = None
+        self.filepath = os.path.join(
+            os.path.dirname(finders.find('test.txt')), 'cached.txt')
+        self._write('cached content')
+        self.handler = StaticFilesHandler(WSGIHandler())
+
+    def tearDown(self):
+        super(TestStaticFilesHandlerCache, self).tearDown()
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = self.old_validate
+        os.remove(self.filepath)
+
+    def _write(self, content):
+        f = open(self.filepath, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+
+    def _get(self, filepath='cached.txt', **extra):
+        environ = RequestFactory().get(
+            posixpath.join(settings.STATIC_URL, filepath), **extra).environ
+        response = self.handler(environ, lambda status, headers: None)
+        try:
+            return ''.join(response)
+        finally:
+            response.close()
+
+    def _get_from_memory(self, **extra):
+        def fail_open(*args, **kwargs):
+            self.fail("The file was opened.")
+        views.open = fail_open
+        try:
+            return self._get(**extra)
+        finally:
+            del views.open
+
+    def test_cached(self):
+        self.assertEqual(self._get(), 'cached content')
+        self.assertTrue('cached.txt' in self.handler.file_cache)
+        self.assertEqual(self._get_from_memory(), 'cached content')
+        self.assertEqual(self._get_from_memory(HTTP_RANGE='bytes=7-'),
+                         'content')
+
+    def test_validate(self):
+        self._get()
+        self._write('changed')
+        os.utime(self.filepath, (0, 0))
+        self.assertEqual(self._get(), 'cached content')
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = 0
+        self.assertEqual(self._get(), 'changed')
+
+    def test_large_file(self):
+        old_max_file_size = settings.STATICFILES_HANDLER_CACHE_MAX_FILE_SIZE
+        settings.STATICFILES_HANDLER_CACHE_MAX_FILE_SIZE = 10
+        try:
+            self.assertEqual(self._get(), 'cached content')
+            self.assertFalse('cached.txt' in self.handler.file_cache)
+        finally:
+            settings.STATICFILES_HANDLER_CACHE_MAX_FILE_SIZE = \
+                old_max_file_size
+
+
+class TestStaticFilesHandler(StaticFilesTestCase):
+    """
+    Test that the ``StaticFilesHandler`` serves files directly.
+    """
+    urls = 'staticfiles.tests.urls.empty'
+
+    def setUp(self):
+        super(TestStaticFilesHandler, self).setUp()
+        self.handler = StaticFilesHandler(WSGIHandler())
+        self.signals = []
+        request_started.connect(self.request_started)
+
+    def tearDown(self):
+        super(TestStaticFilesHandler, self).tearDown()
+        request_started.disconnect(self.request_started)
+
+    def request_started(self, **kwargs):
+        self.signals.append(kwargs)
+
+    def _response(self, filepath):
+        environ = RequestFactory().get(
+            posixpath.join(settings.STATIC_URL, filepath)).environ
+        status_headers = []
+
+        def start_response(status, headers):
+            status_headers[:] = [status, dict(headers)]
+        response = self.handler(environ, start_response)
+        try:
+            content = ''.join(response)
+        finally:
+            response.close()
+        return status_headers[0], status_headers[1], content
+
+    def test_fast_path(self):
+        status, headers, content = self._response('test.txt')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(content, 'Can we find this file?\n')
+        self.assertEqual(self.signals, [])
+
+    def test_not_found(self):
+        status, headers, content = self._response('does/not/exist.txt')
+        self.assertEqual(status, '404 NOT FOUND')
+        self.assertEqual(len(self.signals), 1)
+
+
+class TestCompactManifest(unittest2.TestCase):
+    """
+    Test the memory-mapped manifest format.
+    """
+    def test_lookup(self):
+        hashed_names = {
+            u'css/base.css': u'css/base.0123456789ab.css',
+            u'img/\u2603.png': u'img/\u2603.ba9876543210.png',
+            u'js/app.js': u'js/app.aaaaaaaaaaaa.js',
+        }
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, storage.CompactManifest.dumps(hashed_names))
+            os.close(fd)
+            manifest = storage.CompactManifest(path)
+            try:
+                self.assertEqual(len(manifest), 3)
+                for name, hashed_name in hashed_names.items():
+                    self.assertEqual(manifest.get(name), hashed_name)
+                self.assertEqual(manifest.get(u'css/other.css'), None)
+                self.assertEqual(manifest.get(u'a'), None)
+                self.assertEqual(manifest.get(u'z'), None)
+            finally:
+                manifest.close()
+        finally:
+            os.remove(path)
+
+    def test_invalid(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, 'SFM1\x05\x00\x00\x00')
+            os.close(fd)
+            self.assertRaises(ValueError, storage.CompactManifest, path)
+        finally:
+            os.remove(path)
+
+
+class TestStreamRewriter(unittest2.TestCase):
+    """
+    Test rewriting the matches of several patterns in a single pass.
+    """
+    css = ('@import "a.css";\nbody { background: url(img/b.png) }\n'
+           'p { background: url("img/c d.png") } @import \'e.css\';\n'
+           '.x { content: "url(" }') * 3
+
+    def rewrite(self, rewriter, content):
+        output = []
+        rewriter.rewrite(StringIO(content), output.append,
+                         lambda match: '[%s]' % match.group(2))
+        return ''.join(output)
+
+    def expected(self, patterns, content):
+        for pattern in patterns:
+            content = pattern.sub(lambda match: '[%s]' % match.group(2),
+                                  content)
+        return content
+
+    def test_chunks(self):
+        patterns = [re.compile(pattern) for pattern, template
+                    in storage.CachedFilesMixin.patterns[0][1]]
+        expected = self.expected(patterns, self.css)
+        for chunk_size in (1, 2, 3, 7, 64):
+            for max_token_length in (24, 2 ** 20):
+                rewriter = StreamRewriter(patterns)
+                rewriter.chunk_size = chunk_size
+                rewriter.max_token_length = max_token_length
+                self.assertEqual(self.rewrite(rewriter, self.css), expected)
+
+    def test_skipped_patterns(self):
+        patterns = [re.compile(pattern) for pattern, template
+                    in storage.CachedFilesMixin.patterns[0][1]]
+        skipped_patterns = [re.compile(pattern) for pattern
+                            in storage.CachedFilesMixin.skipped_patterns[0][1]]
+        content = ('/* url(a.png)\n @import "b.css"; */ url(c.png)'
+                   '.x { content: "url(d.png)" } .y { content: \'\\\'url(e)\' }'
+                   ' @import "f.css"; /* url(g.png)')
+        for chunk_size in (1, 5, 64):
+            for max_token_length in (36, 40, 64):
+                rewriter = StreamRewriter(patterns, skipped_patterns)
+                rewriter.chunk_size = chunk_size
+                rewriter.max_token_length = max_token_length
+                self.assertEqual(self.rewrite(rewriter, content), (
+                    '/* url(a.png)\n @import "b.css"; */ [c.png]'
+                    '.x { content: "url(d.png)" } '
+                    '.y { content: \'\\\'url(e)\' } [f.css]; /* url(g.png)'))
+
+    def test_max_token_length(self):
+        rewriter = StreamRewriter([re.compile(r'(url\((.*?)\))')])
+        rewriter.chunk_size = 4
+        rewriter.max_token_length = 10
+        content = 'url(unterminated' + 'x' * 20 + ' url(a)'
+        self.assertEqual(self.rewrite(rewriter, content),
+                         'url(unterminated' + 'x' * 20 + ' [a]')
+
+    def test_without_prefix(self):
+        patterns = [re.compile(r'((\w+)\.png)')]
+        rewriter = StreamRewriter(patterns)
+        rewriter.chunk_size = 2
+        rewriter.max_token_length = 8
+        content = 'a.png, b.gif, c.png' * 5
+        self.assertEqual(self.rewrite(rewriter, content),
+                         self.expected(patterns, content))
+
+
+class TestDependencyOrder(unittest2.TestCase):
+    """
+    Test ordering items after the items they depend on.
+    """
+    def test_order(self):
+        dependencies = {'a': ['b', 'x'], 'b': ['c'], 'd': ['a']}
+        self.assertEqual(
+            dependency_order('abcd', lambda item: dependencies.get(item, [])),
+            ['c', 'b', 'a', 'd'])
+
+    def test_cycle(self):
+        dependencies = {'a': ['b'], 'b': ['c'], 'c': ['a']}
+        self.assertEqual(
+            dependency_order('abcd', lambda item: dependencies.get(item, [])),
+            ['c', 'b', 'a', 'd'])
+
+
+class TestLRUCache(unittest2.TestCase):
+    """
+    Test the size bounded LRU cache.
+    """
+    def test_eviction(self):
+        cache = LRUCache(10)
+        cache.set('a', 1, 4)
+        cache.set('b', 2, 4)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3, 4)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.size, 8)
+        cache.set('d', 4, 11)
+        self.assertFalse('d' in cache)
+        cache.delete('a')
+        self.assertEqual((len(cache), cache.size), (1, 4))
+
+
+class TestStaticRootHandler(CollectionTestCase):
+    """
+    Test serving the collected files with the ``StaticRootHandler``.
+    """
+    urls = 'staticfiles.tests.urls.empty'
+
+    def setUp(self):
+        super(TestStaticRootHandler, self).setUp()
+        settings.DEBUG = False
+        self.old_validate = settings.STATICFILES_HANDLER_CACHE_VALIDATE
+        self.old_staticfiles_storage = settings.STATICFILES_STORAGE
+        self.handler = StaticRootHandler(WSGIHandler())
+
+    def tearDown(self):
+        super(TestStaticRootHandler, self).tearDown()
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = self.old_validate
+        settings.STATICFILES_STORAGE = self.old_staticfiles_storage
+        storage.staticfiles_storage._wrapped = empty
+
+    def _response(self, filepath, **extra):
+        environ = RequestFactory().get(
+            posixpath.join(settings.STATIC_URL, filepath), **extra).environ
+        status_headers = []
+
+        def start_response(status, headers):
+            status_headers[:] = [status, dict(headers)]
+        response = self.handler(environ, start_response)
+        try:
+            content = ''.join(response)
+        finally:
+            response.close()
+        return status_headers[0], status_headers[1], content
+
+    def _get_file(self, filepath):
+        status, headers, content = self._response(filepath)
+        if not status.startswith('200'):
+            raise IOError(status)
+        return content.decode('utf-8')
+
+    def test_serve(self):
+        self.assertFileContains('test/file.txt', 'STATICFILES_DIRS')
+        status, headers, content = self._response('test/file.txt')
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(headers['Content-Length'], str(len(content)))
+        self.assertTrue('Last-Modified' in headers)
+
+    def test_not_found(self):
+        self.assertFileNotFound('does/not/exist.txt')
+        self.assertFileNotFound('../test.txt')
+
+    def test_file_wrapper(self):
+        """
+        The server's ``wsgi.file_wrapper`` is returned to the server.
+        """
+        class ServerFileWrapper(FileWrapper):
+            pass
+        environ = RequestFactory().get(
+            posixpath.join(settings.STATIC_URL, 'test.txt')).environ
+        environ['wsgi.file_wrapper'] = ServerFileWrapper
+        response = self.handler(environ, lambda status, headers: None)
+        try:
+            self.assertTrue(isinstance(response, ServerFileWrapper))
+            self.assertTrue('Can we find' in ''.join(response))
+        finally:
+            response.close()
+
+    def test_not_modified(self):
+        status, headers, content = self._response('test.txt')
+        status, headers, content = self._response(
+            'test.txt', HTTP_IF_MODIFIED_SINCE=headers['Last-Modified'])
+        self.assertTrue(status.startswith('304'))
+        self.assertEqual(content, '')
+
+    def test_precompressed_variant(self):
+        gzip_path = os.path.join(settings.STATIC_ROOT, 'test', 'file.txt.gz')
+        gzip_file = gzip.GzipFile(gzip_path, 'wb')
+        try:
+            gzip_file.write('compressed')
+        finally:
+            gzip_file.close()
+        self.handler = StaticRootHandler(WSGIHandler())
+        status, headers, content = self._response(
+            'test/file.txt', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(content, open(gzip_path, 'rb').read())
+        status, headers, content = self._response('test/file.txt')
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertTrue('STATICFILES_DIRS' in content)
+
+    def _save_hashed_file(self, variants=False):
+        """
+        Saves a copy of a file with a hashed name, listed in the manifest
+        of the ``CachedStaticFilesStorage``.
+        """
+        hashed_path = os.path.join(settings.STATIC_ROOT, 'test',
+                                   'file.0123456789ab.txt')
+        shutil.copy(os.path.join(settings.STATIC_ROOT, 'test', 'file.txt'),
+                    hashed_path)
+        if variants:
+            shutil.copy(hashed_path, hashed_path + '.gz')
+        settings.STATICFILES_STORAGE = \
+            'staticfiles.storage.CachedStaticFilesStorage'
+        storage.staticfiles_storage._wrapped = empty
+        storage.staticfiles_storage.save_manifest(
+            {'test/file.txt': 'test/file.0123456789ab.txt'})
+        self.handler = StaticRootHandler(WSGIHandler())
+
+    def test_hashed_name_etag(self):
+        self._save_hashed_file()
+        status, headers, content = self._response(
+            'test/file.0123456789ab.txt')
+        self.assertEqual(headers['ETag'], '"0123456789ab"')
+
+    def test_hashed_looking_name(self):
+        """
+        Files not listed in the manifest aren't immutable, even if their
+        names look hashed.
+        """
+        hashed_path = os.path.join(settings.STATIC_ROOT, 'test',
+                                   'file.0123456789ab.txt')
+        shutil.copy(os.path.join(settings.STATIC_ROOT, 'test', 'file.txt'),
+                    hashed_path)
+        self.handler = StaticRootHandler(WSGIHandler())
+        status, headers, content = self._response(
+            'test/file.0123456789ab.txt')
+        self.assertNotEqual(headers['ETag'], '"0123456789ab"')
+        self.assertFalse('Cache-Control' in headers)
+
+    def test_cache_control(self):
+        self._save_hashed_file(variants=True)
+        for accept_encoding in ('', 'gzip'):
+            status, headers, content = self._response(
+                'test/file.0123456789ab.txt',
+                HTTP_ACCEPT_ENCODING=accept_encoding)
+            self.assertEqual(headers['Cache-Control'],
+                             'public, max-age=31536000, immutable')
+        status, headers, content = self._response('test/file.txt')
+        self.assertFalse('Cache-Control' in headers)
+
+    def test_overwritten_in_place(self):
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = 0
+        path = os.path.join(settings.STATIC_ROOT, 'test.txt')
+        status, headers, content = self._response('test.txt')
+        f = open(path, 'wb')
+        try:
+            f.write('overwritten')
+        finally:
+            f.close()
+        os.utime(path, (0, 0))
+        status, headers, content = self._response('test.txt')
+        self.assertEqual(content, 'overwritten')
+        self.assertEqual(headers['Content-Length'], str(len('overwritten')))
+
+    def test_collected_later(self):
+        path = os.path.join(settings.STATIC_ROOT, 'later.txt')
+        shutil.copy(os.path.join(settings.STATIC_ROOT, 'test.txt'), path)
+        self.assertFileContains('later.txt', 'Can we find')
+        settings.STATICFILES_HANDLER_CACHE_VALIDATE = None
+        self.assertFileNotFound('collected.txt')
+        shutil.copy(path, os.path.join(settings.STATIC_ROOT,
+                                       'collected.txt'))
+        self.assertFileNotFound('collected.txt')
+
+
 class FinderTestCase(object):
     """
     Base finder test mixin.
@@ -609,6 +2016,61 @@ class TestAppDirectoriesFinder(StaticFilesTestCase, FinderTestCase):
         self.find_first = (os.path.join('test', 'file1.txt'), test_file_path)
         self.find_all = (os.path.join('test', 'file1.txt'), [test_file_path])
 
+    def test_lazy_storages(self):
+        """
+        App storages are only created when an app is looked at.
+        """
+        finder = finders.AppDirectoriesFinder()
+        self.assertEqual(finder._storages, {})
+        finder.find(os.path.join('test', 'file1.txt'))
+        self.assertTrue('staticfiles.tests.apps.test' in finder._storages)
+        self.assertFalse('staticfiles.tests.apps.no_label' in finder._storages)
+        self.assertFalse('staticfiles.tests.apps.skip' in finder.storages)
+        self.assertTrue('staticfiles.tests.apps.no_label' in finder.storages)
+
+    def test_assigned_storages(self):
+        """
+        The storages can still be assigned, e.g. by subclasses.
+        """
+        finder = finders.AppDirectoriesFinder()
+        app = 'staticfiles.tests.apps.test'
+        finder.storages = SortedDict()
+        finder.storages[app] = finder.storage_class(app)
+        self.assertEqual(finder.storages.keys(), [app])
+        self.assertEqual(finder.find(os.path.join('test', 'file1.txt')),
+                         self.find_first[1])
+        self.assertEqual(finder.find('file2.txt'), [])
+
+    def test_changed_storages(self):
+        """
+        The storages are created once and changes to them are kept.
+        """
+        finder = finders.AppDirectoriesFinder()
+        self.assertTrue(finder.storages is finder.storages)
+        app = 'staticfiles.tests.apps.test'
+        del finder.storages[app]
+        self.assertFalse(app in finder.storages)
+        self.assertEqual(finder.find(os.path.join('test', 'file1.txt')), [])
+        finder.storages[app] = finder.storage_class(app)
+        self.assertEqual(finder.find(os.path.join('test', 'file1.txt')),
+                         self.find_first[1])
+
+    def test_app_path_without_import(self):
+        """
+        The app location is found without importing the app module.
+        """
+        app = 'staticfiles.tests.apps.test'
+        app_path = os.path.join(settings.TEST_ROOT, 'apps', 'test')
+        module = sys.modules.pop(app)
+        storage._app_paths.clear()
+        try:
+            self.assertEqual(os.path.normcase(storage.get_app_path(app)),
+                             os.path.normcase(app_path))
+            self.assertFalse(app in sys.modules)
+        finally:
+            sys.modules[app] = module
+            storage._app_paths.clear()
+
 
 class TestDefaultStorageFinder(StaticFilesTestCase, FinderTestCase):
     """
@@ -623,6 +2085,99 @@ class TestDefaultStorageFinder(StaticFilesTestCase, FinderTestCase):
         self.find_all = ('media-file.txt', [test_file_path])
 
 
+class TestFinderIndex(StaticFilesTestCase):
+    """
+    Test the on-disk finder index.
+    """
+    def setUp(self):
+        super(TestFinderIndex, self).setUp()
+        self.index_dir = tempfile.mkdtemp(prefix='staticfiles_index_')
+        self.index_file = os.path.join(self.index_dir, 'index.json')
+        self.old_index = settings.STATICFILES_INDEX
+        finders._indexes.clear()
+
+    def tearDown(self):
+        settings.STATICFILES_INDEX = self.old_index
+        finders._indexes.clear()
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+        super(TestFinderIndex, self).tearDown()
+
+    def test_same_results_as_finders(self):
+        index = finders.FinderIndex.build()
+        for path in ('test.txt', os.path.join('test', 'file.txt'),
+                     os.path.join('prefix', 'test.txt'), 'media-file.txt',
+                     os.path.join('test', 'file1.txt'), 'does/not/exist'):
+            self.assertEqual(index.find(path), finders.find(path))
+            self.assertEqual(index.find(path, all=True),
+                             finders.find(path, all=True))
+
+    def test_save_and_load(self):
+        index = finders.FinderIndex.build()
+        index.save(self.index_file)
+        loaded = finders.FinderIndex.load(self.index_file)
+        self.assertEqual(loaded.paths, index.paths)
+        self.assertTrue(loaded.is_fresh())
+
+    def test_stale_directories(self):
+        index = finders.FinderIndex.build()
+        directory = os.path.join(settings.TEST_ROOT, 'project', 'documents')
+        self.assertTrue(directory in index.directories)
+        index.directories[directory] -= 10
+        self.assertFalse(index.is_fresh())
+
+    def test_stale_settings(self):
+        index = finders.FinderIndex.build()
+        index.fingerprint = 'outdated'
+        self.assertFalse(index.is_fresh())
+
+    def test_find_uses_index(self):
+        finders.FinderIndex({'indexed.txt': ['/indexed/indexed.txt']}).save(
+            self.index_file)
+        settings.STATICFILES_INDEX = self.index_file
+        self.assertEqual(finders.find('indexed.txt'), '/indexed/indexed.txt')
+        self.assertEqual(finders.find('test.txt'), None)
+        self.assertEqual(finders.find('test.txt', all=True), None)
+
+    def test_empty_root(self):
+        root = tempfile.mkdtemp(dir=self.index_dir)
+        old_dirs = settings.STATICFILES_DIRS
+        settings.STATICFILES_DIRS = tuple(old_dirs) + (root,)
+        finders._finders.clear()
+        try:
+            index = finders.FinderIndex.build()
+            self.assertTrue(root in index.directories)
+            self.assertTrue(index.is_fresh())
+            open(os.path.join(root, 'added.txt'), 'w').close()
+            mtime = time.time() + 10
+            os.utime(root, (mtime, mtime))
+            self.assertFalse(index.is_fresh())
+        finally:
+            settings.STATICFILES_DIRS = old_dirs
+            finders._finders.clear()
+
+    def test_directories(self):
+        found = finders.find('test', all=True)
+        self.assertTrue(found)
+        index = finders.FinderIndex.build()
+        index.save(self.index_file)
+        settings.STATICFILES_INDEX = self.index_file
+        self.assertTrue(index.is_directory('test'))
+        self.assertTrue(index.is_directory(''))
+        self.assertFalse(index.is_directory(os.path.join('test', 'file.txt')))
+        self.assertEqual(index.find('test'), None)
+        # directories are looked up by the finders
+        self.assertTrue(finders.get_index() is not None)
+        self.assertEqual(finders.find('test', all=True), found)
+
+    def test_indexstatic_command(self):
+        call_command('indexstatic', output=self.index_file, verbosity='0')
+        settings.STATICFILES_INDEX = self.index_file
+        self.assertEqual(finders.find('test/file.txt', all=True),
+                         finders.FinderIndex.build().find('test/file.txt',
+                                                          all=True))
+        self.assertTrue(finders.get_index() is not None)
+
+
 class TestMiscFinder(TestCase):
     """
     A few misc finder tests.
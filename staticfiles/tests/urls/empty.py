@@ -0,0 +1,3 @@
+from django.conf.urls.defaults import *  # noqa
+
+urlpatterns = patterns('')
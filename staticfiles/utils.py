@@ -1,6 +1,12 @@
 import os
 import fnmatch
+import re
+import sre_constants
+import sre_parse
+import sys
+import threading
 import warnings
+import Queue
 
 
 def get_files_for_app(app, ignore_patterns=None):
@@ -88,3 +94,275 @@ def get_files(storage, ignore_patterns=None, location=''):
             dir = os.path.join(location, dir)
         for fn in get_files(storage, ignore_patterns, dir):
             yield fn
+
+
+def parallel_map(func, items, workers=4):
+    """
+    Return a list with the results of calling ``func`` with each of the
+    given items, using a number of threads, e.g. to read files in parallel.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for position, item in enumerate(items):
+        queue.put((position, item))
+
+    def worker():
+        while not errors:
+            try:
+                position, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[position] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, tb = errors[0]
+        raise exc_type, exc_value, tb
+    return results
+
+
+def dependency_order(items, dependencies):
+    """
+    Returns the given items ordered so that each comes after the items it
+    depends on (as returned by the dependencies function), keeping their
+    order otherwise. Dependencies that aren't in the items or that would
+    close a cycle are ignored.
+    """
+    items = list(items)
+    known = set(items)
+    visited, ordered = set(), []
+    for item in items:
+        if item in visited:
+            continue
+        visited.add(item)
+        # depth-first, with an explicit stack instead of recursion
+        stack = [(item, iter(dependencies(item)))]
+        while stack:
+            current, remaining = stack[-1]
+            for dependency in remaining:
+                if dependency in known and dependency not in visited:
+                    visited.add(dependency)
+                    stack.append((dependency, iter(dependencies(dependency))))
+                    break
+            else:
+                stack.pop()
+                ordered.append(current)
+    return ordered
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping which keeps the most recently used items as long
+    as their total size (1 per item unless given) doesn't exceed the given
+    maximum size. Items larger than the maximum size aren't kept at all.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            # links of a circular doubly linked list: [prev, next, key,
+            # value, size], the most recently used item being root's next
+            self.root = root = []
+            root[:] = [root, root, None, None, 0]
+            self.links = {}
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def _unlink(self, link):
+        prev_link, next_link = link[0], link[1]
+        prev_link[1] = next_link
+        next_link[0] = prev_link
+
+    def _link_first(self, link):
+        root = self.root
+        link[0], link[1] = root, root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._link_first(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, size=1):
+        self.lock.acquire()
+        try:
+            self._delete(key)
+            if size > self.max_size:
+                return
+            link = [None, None, key, value, size]
+            self._link_first(link)
+            self.links[key] = link
+            self.size += size
+            while self.size > self.max_size:
+                self._delete(self.root[0][2])
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self._delete(key)
+        finally:
+            self.lock.release()
+
+    def _delete(self, key):
+        link = self.links.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+            self.size -= link[4]
+
+
+def first_characters(patterns):
+    """
+    Returns the set of characters the matches of the given compiled
+    regular expressions can begin with, or ``None`` if that's not known.
+    """
+    def get_codes(items):
+        if not items:
+            return None
+        op, av = items[0]
+        if op == sre_constants.LITERAL:
+            return set([av])
+        elif op == sre_constants.SUBPATTERN:
+            return get_codes(av[1])
+        elif op == sre_constants.BRANCH:
+            codes = set()
+            for branch in av[1]:
+                branch_codes = get_codes(branch)
+                if branch_codes is None:
+                    return None
+                codes.update(branch_codes)
+            return codes
+        return None
+    codes = set()
+    for pattern in patterns:
+        if pattern.flags & re.IGNORECASE:
+            return None
+        try:
+            pattern_codes = get_codes(
+                sre_parse.parse(pattern.pattern, pattern.flags))
+        except (sre_constants.error, ValueError):
+            return None
+        if pattern_codes is None:
+            return None
+        codes.update(pattern_codes)
+    if [pattern for pattern in patterns
+            if isinstance(pattern.pattern, unicode)]:
+        return set(map(unichr, codes))
+    return set(map(chr, codes))
+
+
+class StreamRewriter(object):
+    """
+    Replaces the matches of several regular expressions in a file with the
+    return value of a converter function in a single pass, as if the first
+    of the expressions matching at the leftmost position of each match
+    was applied. Matches of the skipped expressions (e.g. comments and
+    string literals) are left as they are, including anything in them
+    the other expressions would match.
+
+    The expressions are combined into one alternation, so the text is
+    scanned once by the regular expression engine. The file is read and
+    written in chunks, keeping ``max_token_length`` characters ahead of
+    the rewritten text in memory; matches longer than that may be missed.
+    """
+    chunk_size = 64 * 2 ** 10
+    max_token_length = 2 ** 20
+
+    def __init__(self, patterns, skipped_patterns=()):
+        patterns = list(patterns)
+        skipped_patterns = list(skipped_patterns)
+        self.alternatives = {}
+        parts, flags, index = [], 0, 1
+        for pattern in patterns + skipped_patterns:
+            self.alternatives[index] = (pattern, pattern in skipped_patterns)
+            parts.append('(%s)' % pattern.pattern)
+            flags |= pattern.flags
+            index += pattern.groups + 1
+        scanner = '|'.join(parts)
+        characters = first_characters(patterns + skipped_patterns)
+        if characters:
+            # lets the regular expression engine skip to the next
+            # position where one of the expressions can match
+            scanner = '(?=[%s])(?:%s)' % (
+                ''.join([re.escape(c) for c in sorted(characters)]), scanner)
+        self.scanner = re.compile(scanner, flags)
+
+    def rewrite(self, input_file, write, converter):
+        """
+        Reads the given file and passes the text with the matches replaced
+        with the return values of the converter to the write function.
+        """
+        text, eof = '', False
+        while not eof:
+            chunks, length = [text], len(text)
+            while length < 2 * self.max_token_length:
+                chunk = input_file.read(self.chunk_size)
+                if not chunk:
+                    eof = True
+                    break
+                chunks.append(chunk)
+                length += len(chunk)
+            text = ''.join(chunks)
+            text = text[self.rewrite_text(text, eof, write, converter):]
+
+    def rewrite_text(self, text, eof, write, converter):
+        """
+        Rewrites the given text, returning the position up to which it
+        has been written. Unless it's the end of the file, the last
+        ``max_token_length`` characters are only looked at to complete
+        the matches beginning before them.
+        """
+        length = len(text)
+        if eof:
+            limit = length
+        else:
+            limit = length - self.max_token_length
+        position = scanned = 0
+        for match in self.scanner.finditer(text):
+            begin, end = match.span()
+            if not eof and (begin >= limit or end == length and
+                            end - begin < self.max_token_length):
+                # wait for more text to tell where the match ends
+                limit = min(begin, limit)
+                break
+            scanned = end
+            pattern, skipped = self.alternatives[match.lastindex]
+            if skipped:
+                continue
+            write(text[position:begin])
+            # match again to pass the converter the expression's own groups
+            write(converter(pattern.match(text, begin)))
+            position = end
+        scanned = max(scanned, limit)
+        write(text[position:scanned])
+        return scanned
@@ -1,18 +1,448 @@
 """
-Views and functions for serving static files. These are only to be used during
-development, and SHOULD NOT be used in a production setting.
+Views and functions for serving static files. The serve view is only to be
+used during development, and SHOULD NOT be used in a production setting.
 
 """
+import mimetypes
 import os
 import posixpath
+import time
 import urllib
+import uuid
+from wsgiref.util import FileWrapper
 
-from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date
 from django.views import static
 
 from staticfiles import finders
+from staticfiles.conf import settings
+from staticfiles.storage import (get_original_name, staticfiles_storage,
+                                 PRECOMPRESSED_VARIANTS)
+from staticfiles.utils import LRUCache
+
+STREAM_CHUNK_SIZE = 64 * 2 ** 10
+# More ranges than this in a Range header are ignored
+MAX_RANGES = 16
+# The maximum number of files whose variants are remembered by the view
+MAX_VARIANTS_ENTRIES = 10000
+
+_variants = LRUCache(MAX_VARIANTS_ENTRIES)
+_misses = LRUCache(settings.STATICFILES_MISSES_MAX_ENTRIES)
+
+
+class StaticFile(object):
+    """
+    A file to be served, along with the headers of its responses, which
+    are only computed once.
+
+    The strong ETag of the file is the given hash of its content (the one
+    in the name of a file saved by the ``CachedFilesMixin``) or otherwise
+    derived from its inode, size and modification time. Immutable files,
+    whose names change with their content, are cached by clients according
+    to the STATICFILES_HASHED_CACHE_CONTROL setting, all others according
+    to the STATICFILES_CACHE_CONTROL setting.
+
+    The content of the file is read from disk when served, unless it has
+    been loaded into memory with ``load()``.
+    """
+    def __init__(self, path, statobj=None, content_hash=None,
+                 immutable=False):
+        if statobj is None:
+            statobj = os.stat(path)
+        self.path = path
+        self.immutable = immutable
+        self.size = statobj.st_size
+        self.mtime = statobj.st_mtime
+        if content_hash is None:
+            content_hash = md5_constructor('%s-%s-%s' % (
+                statobj.st_ino, self.size, self.mtime)).hexdigest()
+        self.etag = '"%s"' % content_hash
+        self.last_modified = http_date(self.mtime)
+        content_type, encoding = mimetypes.guess_type(path)
+        self.content_type = content_type or 'application/octet-stream'
+        self.headers = [
+            ('Last-Modified', self.last_modified),
+            ('ETag', self.etag),
+            ('Accept-Ranges', 'bytes'),
+            ('Content-Length', str(self.size)),
+        ]
+        if encoding:
+            self.headers.append(('Content-Encoding', encoding))
+        if immutable:
+            self.cache_control = settings.STATICFILES_HASHED_CACHE_CONTROL
+        else:
+            self.cache_control = settings.STATICFILES_CACHE_CONTROL
+        if self.cache_control:
+            self.headers.append(('Cache-Control', self.cache_control))
+        # A list of precompressed variants as (content coding, StaticFile)
+        self.variants = []
+        self.content = None
+
+    def load(self):
+        """
+        Reads the content of the file into memory, returning ``False`` if
+        the file has changed since its size was determined.
+        """
+        fp = open(self.path, 'rb')
+        try:
+            content = fp.read()
+        finally:
+            fp.close()
+        if len(content) != self.size:
+            return False
+        self.content = content
+        return True
+
+
+def get_static_file(absolute_path):
+    """
+    Returns a ``StaticFile`` instance with the precompressed variants for
+    the source file at the given absolute path, as found by the finders.
+    Source files aren't saved by the ``CachedFilesMixin``, so they're never
+    immutable, even if their names look hashed.
+    """
+    return find_variants(StaticFile(absolute_path))
+
+
+def get_miss_state(path):
+    """
+    Returns what has to change for the finders to find a file with the
+    given normalized path they didn't find before: the finder index, or
+    the directories the file would be in if there is none.
+    """
+    # The finders don't look in the directories if there is an index
+    return finders.get_index() or finders.get_parent_mtimes(path)
+
+
+def find_file(path):
+    """
+    Returns the absolute path of the file the finders find for the given
+    normalized path. Paths which aren't found are remembered until the
+    finder index or the directories they would be in change (checked at
+    most every ``STATICFILES_MISSES_VALIDATE`` seconds), to not look for
+    them in all locations again.
+    """
+    now = time.time()
+    entry = _misses.get(path)
+    if entry is not None:
+        checked, state = entry
+        validate = settings.STATICFILES_MISSES_VALIDATE
+        if validate is None or now - checked < validate:
+            return None
+        if get_miss_state(path) == state:
+            entry[0] = now
+            return None
+    # Determine the state first, to not miss a file added in between
+    state = get_miss_state(path)
+    absolute_path = finders.find(path)
+    if absolute_path:
+        _misses.delete(path)
+    else:
+        _misses.set(path, [now, state])
+    return absolute_path
+
+
+def find_variants(static_file):
+    """
+    Sets the precompressed variants of the given ``StaticFile`` instance
+    from the files next to it, remembering them by path and modification
+    time. The remembered variants are only looked for again (to notice
+    added, changed and deleted ones) after the number of seconds of the
+    ``STATICFILES_HANDLER_CACHE_VALIDATE`` setting.
+    """
+    now = time.time()
+    key = (static_file.path, static_file.mtime)
+    entry = _variants.get(key)
+    remembered = {}
+    if entry is not None:
+        checked, variants = entry
+        validate = settings.STATICFILES_HANDLER_CACHE_VALIDATE
+        if validate is None or now - checked < validate:
+            static_file.variants = variants
+            return static_file
+        remembered = dict(variants)
+    variants = []
+    for encoding, suffix in PRECOMPRESSED_VARIANTS:
+        path = static_file.path + suffix
+        try:
+            statobj = os.stat(path)
+        except OSError:
+            continue
+        variant = remembered.get(encoding)
+        if variant is None or (statobj.st_mtime, statobj.st_size) != (
+                variant.mtime, variant.size):
+            variant = StaticFile(path, statobj,
+                                 immutable=static_file.immutable)
+        variants.append((encoding, variant))
+    _variants.set(key, [now, variants])
+    static_file.variants = variants
+    return static_file
+
+
+def is_immutable_name(name, hashed_names):
+    """
+    Checks if the content of the file with the given name never changes,
+    because it (or the file a precompressed variant was made of) is one of
+    the given names the ``CachedFilesMixin`` saved files with, containing
+    the hash of their content. Files whose references the
+    ``STATICFILES_STORAGE`` adjusts keep their hashed name when a file they
+    refer to changes, so they aren't immutable.
+    """
+    if get_original_name(name) not in hashed_names:
+        return False
+    is_adjustable = getattr(staticfiles_storage, 'is_adjustable', None)
+    return not (is_adjustable is not None and
+                is_adjustable(get_original_name(name)))
+
+
+def parse_accept_encoding(header):
+    """
+    Returns a dict of the content codings of an Accept-Encoding header
+    and their quality values.
+    """
+    encodings = {}
+    for item in header.split(','):
+        params = item.split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encodings[encoding] = quality
+    return encodings
+
+
+def select_variant(request, static_file):
+    """
+    Returns the preferred precompressed variant of the given
+    ``StaticFile`` instance the client accepts, or the file itself.
+    """
+    if not static_file.variants:
+        return static_file
+    accepted = parse_accept_encoding(
+        request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    for encoding, variant in static_file.variants:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return variant
+    return static_file
+
+
+def etag_matches(etag, if_none_match):
+    """
+    Checks if the given ETag matches one of the ETags in the value of an
+    If-None-Match header (using the weak comparison).
+    """
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def is_not_modified(request, static_file):
+    """
+    Checks the conditional headers of the request to tell if the client's
+    copy of the given ``StaticFile`` is still fresh. If-None-Match takes
+    precedence over If-Modified-Since.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag_matches(static_file.etag, if_none_match)
+    return not static.was_modified_since(
+        request.META.get('HTTP_IF_MODIFIED_SINCE'),
+        static_file.mtime, static_file.size)
+
+
+def parse_range_header(header, size):
+    """
+    Parses the value of a Range header for a file of the given size.
+
+    Returns a list of the satisfiable byte ranges as (first, last) tuples
+    (empty if none is satisfiable), or ``None`` if the header is invalid or
+    has too many ranges and should be ignored.
+    """
+    units, _, range_set = header.partition('=')
+    if units.strip() != 'bytes':
+        return None
+    specs = range_set.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                first = int(first)
+                if last:
+                    last = int(last)
+                    if last < first:
+                        return None
+                else:
+                    last = size - 1
+            else:
+                # a suffix range of the last N bytes
+                suffix_length = int(last)
+                if suffix_length <= 0:
+                    continue
+                first, last = max(size - suffix_length, 0), size - 1
+        except ValueError:
+            return None
+        if first >= size:
+            continue
+        ranges.append((first, min(last, size - 1)))
+    return ranges
+
+
+def get_ranges(request, static_file):
+    """
+    Returns the byte ranges requested for the given ``StaticFile``
+    instance, or ``None`` if the whole file should be served, e.g. since
+    the file has changed according to the If-Range header.
+    """
+    range_header = request.META.get('HTTP_RANGE')
+    if not range_header or request.method not in ('GET', 'HEAD'):
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and if_range.strip() not in (
+            static_file.etag, static_file.last_modified):
+        return None
+    return parse_range_header(range_header, static_file.size)
+
+
+def iter_file_parts(path, parts, trailer=''):
+    """
+    Yields the given parts of the file, each a tuple of a prefix (e.g. the
+    headers of a multipart body part), the first byte and the number of
+    bytes to read, followed by the trailer.
+    """
+    fp = open(path, 'rb')
+    try:
+        for prefix, first, length in parts:
+            if prefix:
+                yield prefix
+            fp.seek(first)
+            while length > 0:
+                chunk = fp.read(min(length, STREAM_CHUNK_SIZE))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        if trailer:
+            yield trailer
+    finally:
+        fp.close()
+
+
+def serve_ranges(request, static_file, ranges):
+    """
+    Returns a partial content response with the given byte ranges of the
+    ``StaticFile`` instance, using a multipart body for more than one range.
+    """
+    if not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%s' % static_file.size
+        return response
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        content_type = static_file.content_type
+        parts = [('', first, last - first + 1)]
+        trailer = ''
+        content_length = last - first + 1
+    else:
+        boundary = uuid.uuid4().hex
+        content_type = 'multipart/byteranges; boundary=%s' % boundary
+        parts = []
+        for first, last in ranges:
+            prefix = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                      'Content-Range: bytes %s-%s/%s\r\n\r\n' %
+                      (boundary, static_file.content_type,
+                       first, last, static_file.size))
+            parts.append((prefix, first, last - first + 1))
+        trailer = '\r\n--%s--\r\n' % boundary
+        content_length = len(trailer) + sum(
+            [len(head) + count for head, start, count in parts])
+    if request.method == 'HEAD':
+        content = ''
+    elif static_file.content is not None:
+        content = ''.join([head + static_file.content[start:start + count]
+                           for head, start, count in parts]) + trailer
+    else:
+        content = iter_file_parts(static_file.path, parts, trailer)
+    response = HttpResponse(content, content_type=content_type, status=206)
+    for header, value in static_file.headers:
+        response[header] = value
+    response['Content-Length'] = str(content_length)
+    if len(ranges) == 1:
+        response['Content-Range'] = 'bytes %s-%s/%s' % (
+            first, last, static_file.size)
+    return response
+
+
+def serve_file(request, static_file):
+    """
+    Returns a response for the given ``StaticFile`` instance, or for its
+    precompressed variant if the client accepts it.
+    """
+    response = file_response(request, select_variant(request, static_file))
+    if static_file.variants:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def file_response(request, static_file):
+    """
+    Returns a response streaming the given ``StaticFile`` instance, or
+    a 304 response without opening the file if the client's copy is still
+    fresh. Range requests are answered with the requested bytes only and
+    HEAD requests with the headers only, without opening the file either.
+
+    The file is wrapped with the WSGI server's ``wsgi.file_wrapper`` if
+    available (which the handlers pass on to the server to allow it to use
+    e.g. sendfile) and otherwise read in chunks of a fixed size. Files
+    loaded into memory are served from there.
+    """
+    if is_not_modified(request, static_file):
+        response = HttpResponseNotModified(
+            content_type=static_file.content_type)
+        response['ETag'] = static_file.etag
+        if static_file.cache_control:
+            response['Cache-Control'] = static_file.cache_control
+        return response
+    ranges = get_ranges(request, static_file)
+    if ranges is not None:
+        return serve_ranges(request, static_file, ranges)
+    if request.method == 'HEAD' or static_file.content is not None:
+        if request.method == 'HEAD':
+            content = ''
+        else:
+            content = static_file.content
+        response = HttpResponse(content, content_type=static_file.content_type)
+        for header, value in static_file.headers:
+            response[header] = value
+        return response
+    file_wrapper = request.META.get('wsgi.file_wrapper', FileWrapper)
+    content = file_wrapper(open(static_file.path, 'rb'), STREAM_CHUNK_SIZE)
+    response = HttpResponse(content, content_type=static_file.content_type)
+    for header, value in static_file.headers:
+        response[header] = value
+    response.file_to_stream = content
+    return response
 
 
 def serve(request, path, document_root=None, insecure=False, **kwargs):
@@ -26,17 +456,23 @@ def serve(request, path, document_root=None, insecure=False, **kwargs):
 
     in your URLconf.
 
-    It automatically falls back to django.views.static
+    It only falls back to django.views.static to show directory indexes
+    if the ``show_indexes`` parameter is given.
     """
     if not settings.DEBUG and not insecure:
         raise ImproperlyConfigured("The staticfiles view can only be used in "
                                    "debug mode or if the the --insecure "
                                    "option of 'runserver' is used")
     normalized_path = posixpath.normpath(urllib.unquote(path)).lstrip('/')
-    absolute_path = finders.find(normalized_path)
+    absolute_path = find_file(normalized_path)
     if not absolute_path:
         if path.endswith('/') or path == '':
             raise Http404("Directory indexes are not allowed here.")
         raise Http404("'%s' could not be found" % path)
-    document_root, path = os.path.split(absolute_path)
-    return static.serve(request, path, document_root=document_root, **kwargs)
+    if os.path.isdir(absolute_path):
+        if kwargs.get('show_indexes'):
+            document_root, path = os.path.split(absolute_path)
+            return static.serve(request, path, document_root=document_root,
+                                **kwargs)
+        raise Http404("Directory indexes are not allowed here.")
+    return serve_file(request, get_static_file(absolute_path))